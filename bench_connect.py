@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Benchmarks
+
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Times GatherCloud against the local mock server. Results are appended to a
+ history file tagged with the plugin version so releases can be compared,
+ ~/.gather_connect/bench_history.jsonl unless --history says otherwise.
+
+    %PYTHONHOME%/python.exe bench_connect.py --features 1000 10000 --latency 0.05
+    %PYTHONHOME%/python.exe bench_connect.py --only codec
+"""
+import argparse
+import configparser
+import json
+import os.path
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import gather_connect_codec as codec
+from gather_connect_cloud import GatherCloud
+from gather_connect_files import STORE_FOLDER
+from gather_connect_mock import MockGatherServer, ProjectSpec, make_project
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# outside the checkout, so runs on any branch add to the same history
+HISTORY = os.path.join(os.path.expanduser("~"), ".gather_connect", "bench_history.jsonl")
+
+
+def plugin_version():
+    metadata = configparser.ConfigParser()
+    metadata.read(os.path.join(HERE, "metadata.txt"))
+    return metadata.get("general", "version", fallback="unknown")
+
+
+def measure(task, reset=None):
+    """
+    Runs task twice: once timed, then again for its peak python heap, as tracing
+    allocations would slow the timed run
+
+    @param task: callable
+    @param reset: callable undoing the task's side effects (e.g. files it stored) between the runs
+    @return: (result, seconds, peak bytes)
+    """
+    start = time.perf_counter()
+    result = task()
+    seconds = time.perf_counter() - start
+    if reset:
+        reset()
+    tracemalloc.start()
+    try:
+        task()
+        return result, seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_cloud(spec, latency):
+    """
+    Benchmarks GatherCloud operations on one synthetic project
+
+    @param spec: ProjectSpec
+    @param latency: seconds the mock server adds to every request
+    @return: [result rows]
+    """
+    rows = []
+    with MockGatherServer([spec], latency=latency) as server, tempfile.TemporaryDirectory() as folder:
+        cloud = GatherCloud("bench@example.com", "bench", host=server.host, secure=False)
+        cloud.fetch_project_list()
+        size = len(server.project_bytes(spec.id))
+        files = spec.features * spec.files_per_feature
+
+        def row(name, seconds, peak, items, nbytes):
+            rows.append({
+                "benchmark": name,
+                "features": spec.features,
+                "latency": latency,
+                "seconds": round(seconds, 4),
+                "peak_mb": round(peak / 2 ** 20, 2),
+                "items_per_s": round(items / seconds, 1),
+                "mb_per_s": round(nbytes / 2 ** 20 / seconds, 2),
+            })
+
+        project, seconds, peak = measure(lambda: cloud.fetch_project(spec.name))
+        row("fetch_project", seconds, peak, spec.features, size)
+
+        path = os.path.join(folder, spec.name + ".geojson")
+        _, seconds, peak = measure(lambda: cloud.download_project(spec.name, path))
+        row("download_project", seconds, peak, spec.features, size)
+
+        def remove_files():
+            shutil.rmtree(os.path.join(folder, spec.name), ignore_errors=True)
+            shutil.rmtree(os.path.join(folder, STORE_FOLDER), ignore_errors=True)
+
+        _, seconds, peak = measure(lambda: cloud.download_project_files(spec.name, folder), remove_files)
+        row("download_project_files", seconds, peak, files, files * spec.file_size)
+
+        _, seconds, peak = measure(lambda: cloud.add_fc_to_project(spec.name, "bench", spec.id, project))
+        row("add_fc_to_project", seconds, peak, spec.features, size)
+    return rows
+
+
+def bench_codec(spec):
+    """
+    Benchmarks each installed JSON backend decoding and encoding a synthetic project
+
+    @param spec: ProjectSpec
+    @return: [result rows]
+    """
+    project = make_project(spec)
+    data = codec.CODECS['json'].dumpb(project)
+    raws = [codec.CODECS['json'].dumpb(feature) for feature in project['features']]
+    rows = []
+    try:
+        for name in codec.CODECS:
+            codec.use(name)
+            for step, task, nbytes in (
+                ("loads", lambda: codec.loads(data), len(data)),
+                ("dumpb", lambda: codec.dumpb(project), len(data)),
+                ("manifest", lambda: [codec.feature_manifest(raw) for raw in raws], len(data)),
+            ):
+                _, seconds, peak = measure(task)
+                rows.append({
+                    "benchmark": f"codec {name} {step}",
+                    "features": spec.features,
+                    "latency": 0.0,
+                    "seconds": round(seconds, 4),
+                    "peak_mb": round(peak / 2 ** 20, 2),
+                    "items_per_s": round(spec.features / seconds, 1),
+                    "mb_per_s": round(nbytes / 2 ** 20 / seconds, 2),
+                })
+    finally:
+        codec.use()
+    return rows
+
+
+def compare(rows, history):
+    """ Prints each result next to the latest result of an earlier version """
+    previous = {}
+    version = rows[0]["version"] if rows else None
+    for old in history:
+        if old["version"] != version:
+            previous[(old["benchmark"], old["features"], old["latency"])] = old
+    for row in rows:
+        old = previous.get((row["benchmark"], row["features"], row["latency"]))
+        change = f"  ({(row['seconds'] / old['seconds'] - 1) * 100:+.0f}% vs {old['version']})" if old else ""
+        print(
+            f"{row['benchmark']:<28} {row['features']:>8} features {row['seconds']:>9.3f}s "
+            f"{row['peak_mb']:>8.1f} MB peak {row['items_per_s']:>10.1f}/s{change}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gather Connector benchmarks")
+    parser.add_argument("--features", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--files-per-feature", type=int, default=1)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--history", default=HISTORY, help="jsonl file results are appended to")
+    parser.add_argument("--only", choices=["cloud", "codec"], help="run one group of benchmarks")
+    args = parser.parse_args(argv)
+
+    run = {"version": plugin_version(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version()}
+    rows = []
+    for features in args.features:
+        spec = ProjectSpec(
+            f"bench {features}", features, files_per_feature=args.files_per_feature, file_size=args.file_size
+        )
+        if args.only != "codec":
+            rows += [{**run, **row} for row in bench_cloud(spec, args.latency)]
+        if args.only != "cloud":
+            rows += [{**run, **row} for row in bench_codec(spec)]
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    compare(rows, history)
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    with open(args.history, "a") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+if __name__ == '__main__':
+    main()
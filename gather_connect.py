@@ -18,229 +18,115 @@
  *                                                                         *
  ***************************************************************************/
 """
-from dataclasses import dataclass
-
-from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication, QObject, QThread, pyqtSignal
-from qgis.PyQt.QtGui import QIcon
+from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication, pyqtSignal
+from qgis.PyQt.QtCore import QUrl
+from qgis.PyQt.QtGui import QIcon, QDesktopServices
 from qgis.PyQt.QtWidgets import QAction, QFileDialog
-from qgis.core import QgsProject, QgsVectorLayer, QgsJsonExporter, QgsProcessingFeedback, Qgis
+from qgis.core import QgsProject, QgsVectorLayer, QgsProcessingFeedback, QgsAction, QgsMessageLog, Qgis
+from qgis.core import QgsApplication, QgsTask, QgsVectorLayerFeatureSource
 import json
-import http.client
-import base64
 
 # Initialize Qt resources from file resources.py
 from .resources import *
 # Import the code for the dialog
 from .gather_connect_dialog import GatherConnectorDialog
+from .gather_connect_cloud import FORMATS, GatherCloud, Message, UploadOptions
+from .gather_connect_layers import export_layer, infer_layer_form, layer_exporter, layer_fields
+from .gather_connect_files import BlobStore, IMAGE_EXTENSIONS, THUMBNAIL_FOLDER, THUMBNAIL_SIZE
+from .gather_connect_convert import LAYER_NAMES, STREAM_FORMATS, driver_available, install_shards
+from .gather_connect_net import FetchError, CircuitOpenError, CancelledError, CancelToken, Progress
 import os.path
 
-HOST = "eu-west-1.aws.data.mongodb-api.com"
-LIST_PROJECTS_URL = "/app/gatherapplication-mgejo/endpoint/listprojects"
-PROJECT_URL = "/app/gatherapplication-mgejo/endpoint/project?id="
-FEATURE_URL = "/app/gatherapplication-mgejo/endpoint/feature?id="
-GET_FILE_URL = "/app/gatherapplication-mgejo/endpoint/file?name="
+METRICS_FOLDER = ".gather_metrics"
 
 
-@dataclass
-class Message:
+class GatherTask(QgsTask):
     """
-    A message to be handled by GatherConnector.msg_user
-    properties are the parameters accepted by:
-    https://api.qgis.org/api/classQgsMessageBar.html#ab018174e31107764e654d50292ef1f3a
-    TODO pass Message direct to QgsMessageBar.pushMessage?
-
-    @param title: gist of it
-    @param text:  main message content
-    @param level: one of:
-        1. Info
-        2. Warning
-        3. Critical
-        4. Success
+    Runs a task in QGIS's task manager, which shows its progress in the status bar and can cancel it.
+    The task is called with this GatherTask, for its cancel token, report and stage.emit
     """
-    title: str
-    text: str
-    level: int = Qgis.Info
-    duration: int = None
-
-    def __post_init__(self):
-        if self.duration is None:
-            self.duration = 5
-
-    def as_list(self):
-        return [self.title, self.text, self.level, self.duration]
-
-
-class Fetch:
-    """ Request data return response """
-    @staticmethod
-    def request(host, url, headers, payload='', verb="GET"):
-        conn = http.client.HTTPSConnection(host)
-        conn.request(verb, url, payload, headers)
-        res = conn.getresponse()
-        return res
-
-
-class Worker(QObject):
-    """A worker will complete a task and return the result"""
 
-    finished = pyqtSignal(object)
+    stage = pyqtSignal(object)
+    status = pyqtSignal(str)
 
-    def __init__(self, task):
-        super().__init__()
+    def __init__(self, description, task, handle_result):
+        super().__init__(description, QgsTask.CanCancel)
         self.task = task
+        self.handle_result = handle_result
+        self.token = CancelToken()
+        self.progress = Progress()
+        self.result = None
 
     def run(self):
-        result = self.task()
-        self.finished.emit(result)
-
-
-class TaskManager:
-    """Manages workers: gives them a task and thread to work in. Connects the result to handler on complete"""
-
-    def __init__(self, set_btns_enabled):
-        self.thread = None
-        self.worker = None
-        self.set_btns_enabled = lambda: set_btns_enabled(True)
-
-    def run_thread(self, task, handle_result):
-        # Instantiates thread & worker
-        self.thread = QThread()
-        self.worker = Worker(task)
-        self.worker.moveToThread(self.thread)
-
-        # Sets task ago, awaits finish
-        self.thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self.thread.quit)
-
-        # Kills thread & worker (don't tell HR)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-
-        # Handles result
-        self.thread.finished.connect(self.set_btns_enabled)
-        self.worker.finished.connect(handle_result)
-        self.thread.start()
-
-
-class GatherCloud:
-    """ Manages calls to the API """
-
-    def __init__(self, email, password):
-        self.email = email
-        self.password = password
-        self.project_list = []
-
-    def fetch_project_list(self):
-        """
-        lists Gather projects available to user
-
-        @return: [projects]
-        """
-        headers = {
-            'email': self.email,
-            'password': self.password
-        }
-        res = Fetch.request(host=HOST, url=LIST_PROJECTS_URL, headers=headers)
-        self.project_list = json.loads(res.read().decode())
-        return self.project_list
-
-    def fetch_project(self, selected_project):
+        try:
+            self.result = self.task(self)
+        except (FetchError, CircuitOpenError, CancelledError, OSError, ValueError) as ex:
+            if self.token.cancelled:
+                self.result = Message("Cancelled", self.description(), Qgis.Warning)
+            else:
+                self.result = Message("Failed", str(ex), Qgis.Critical)
+        # QGIS lists the task as failed rather than complete
+        return not (isinstance(self.result, Message) and self.result.level in (Qgis.Warning, Qgis.Critical))
+
+    def finished(self, ok):
+        if self.result is None:
+            # cancelled before it started, or run raised something unexpected
+            if self.isCanceled():
+                self.result = Message("Cancelled", self.description(), Qgis.Warning)
+            else:
+                self.result = Message("Failed", self.description(), Qgis.Critical)
+        self.handle_result(self.result)
+
+    def cancel(self):
+        self.token.cancel()
+        super().cancel()
+
+    def report(self, stage, done, total=None):
         """
-        Fetches project geojson
-
-        @param selected_project: Project to fetch
-        @return: project geojson
+        Progress callback for GatherCloud, see Progress.update
         """
-        id = [p['id'] for p in self.project_list if p['name'] == selected_project][0]
-        res = Fetch.request(
-            host=HOST,
-            url=PROJECT_URL + id,
-            headers={
-                'email': self.email,
-                'password': self.password
-            }
-        )
-        project_data = json.loads(res.read().decode())
+        percent, text = self.progress.update(stage, done, total)
+        if percent is not None:
+            self.setProgress(percent)
+        self.status.emit(text)
 
-        return project_data
 
-    def download_project_files(self, selected_project, folder):
-        """
-        Downloads files associated with features in a project
-
-        @param selected_project: project name
-        @param folder: download path
-        @return: Success/Fail Message
-        """
-        # get project
-        if not folder:
-            return Message("Error", "Project folder doesn't exist!", Qgis.Warning)
-        project_local_folder = folder + "/" + selected_project
-
-        project_data = self.fetch_project(selected_project)
-        fc = 0
-        for feature in project_data['features']:
-            if "files" not in feature['properties']:
-                continue
-            for file in feature['properties']['files']:
-                fc += 1
-                res = Fetch.request(
-                    host=HOST,
-                    url=GET_FILE_URL + file['name'],
-                    headers={
-                        'email': self.email,
-                        'password': self.password
-                    }
-                )
-                data = res.read()
-                if not os.path.exists(project_local_folder):
-                    os.makedirs(project_local_folder)
-                with open(project_local_folder + "/" + file['name'], "wb") as f:
-                    f.write(base64.b64decode(data))
+class TaskManager:
+    """Manages tasks: hands them to QGIS's task manager. Connects the result to handler on complete"""
 
-        return Message("Success", f"{str(fc)} files downloaded", Qgis.Success)
+    def __init__(self, set_btns_enabled, show_status):
+        # keep a reference to every running task, QGIS only owns their C++ side
+        self.tasks = set()
+        self.set_btns_enabled = set_btns_enabled
+        self.show_status = show_status
 
-    def download_project(self, selected_project, dwnld_path):
+    def run_thread(self, task, handle_result, handle_stage=None, description="Gather Connector"):
         """
-        Downloads a project as geojson
+        Several tasks may run at once, e.g. opening a feature's files whilst its project's files sync.
+        Buttons are enabled again once the last of them is done.
 
-        @param selected_project: project name
-        @param dwnld_path: path to geojson file
-        @return: (project name, download path)
+        @param task: callable taking the GatherTask, run in a background thread
+        @param handle_result: called with the task's result (or a failure Message) in the main thread
+        @param handle_stage: called in the main thread with whatever the task passes to stage.emit
+        @param description: shown in the status bar
         """
-        project_data = self.fetch_project(selected_project)
-        with open(dwnld_path, 'w') as f:
-            json.dump(project_data, f)
-        return selected_project, dwnld_path
+        def done(result):
+            self.tasks.discard(gather_task)
+            if not self.tasks:
+                self.set_btns_enabled(True)
+            handle_result(result)
 
-    def add_fc_to_project(self, project_name, layer_name, project_id, fc):
-        """
-        Adds a featureclass to a project
+        gather_task = GatherTask(description, task, done)
+        self.tasks.add(gather_task)
+        gather_task.status.connect(self.show_status)
+        if handle_stage is not None:
+            gather_task.stage.connect(handle_stage)
+        QgsApplication.taskManager().addTask(gather_task)
 
-        @param project_name: project to which you wish to add a layer
-        @param layer_name: name of layer to add
-        @param project_id: id of project to add layer to
-        @param fc: geojson featureclass of the layer being added
-        @return: Success/fail Message
-        """
-        try:
-            payload = json.dumps({"name": layer_name, "geojson": fc})
-            res = Fetch.request(verb="POST", host=HOST, url=FEATURE_URL + project_id, payload=payload, headers={
-                'email': self.email,
-                'password': self.password,
-                'Content-Type': 'application/json'
-            })
-            result = json.loads(res.read().decode())
-        except Exception as ex:
-            return Message('Failed', str(ex), Qgis.Critical)
-        if result['success']:
-            return Message(
-                "Success",
-                f"Added {str(result['featureCount'])} features and {str(result['formCount'])} forms to {project_name}",
-                Qgis.Success
-            )
-        else:
-            return Message("Failed", str(result['error']), Qgis.Critical)
+    def cancel(self):
+        """ Cancels the running tasks, aborting their requests """
+        for task in list(self.tasks):
+            task.cancel()
 
 
 class GatherConnector:
@@ -283,7 +169,7 @@ class GatherConnector:
         self.gather_cloud = None
         self.logger = QgsProcessingFeedback()
         self.push_msg = self.iface.messageBar().pushMessage
-        self.task_manager = TaskManager(self.set_btns_enabled)
+        self.task_manager = TaskManager(self.set_btns_enabled, self.show_status)
 
     # noinspection PyMethodMayBeStatic
     def tr(self, message):
@@ -390,6 +276,7 @@ class GatherConnector:
     def unload(self):
         """Removes the plugin menu item and icon from QGIS GUI."""
 
+        self.task_manager.cancel()
         for action in self.actions:
             self.iface.removePluginMenu(
                 self.tr(u'&Gather Connector'),
@@ -415,6 +302,35 @@ class GatherConnector:
 
         self.logger.pushConsoleInfo(msg)
 
+    def report_metrics(self, metrics):
+        """
+        Logs a job's timings to the QGIS log panel, and exports them to the local project folder
+        when Export timings is checked
+
+        @param metrics: JobMetrics of a finished job
+        """
+        metrics.finish()
+        QgsMessageLog.logMessage(metrics.summary(), "Gather Connector", Qgis.Info)
+        folder = self.get_local_project_folder()
+        if not folder or not self.dlg.metricsCheckBox.isChecked():
+            return
+        metrics.save(os.path.join(folder, METRICS_FOLDER))
+
+    def handle_job_finished(self, msg, metrics):
+        """
+        Alerts user of a job's outcome and reports its timings
+
+        @param msg: Message
+        @param metrics: JobMetrics of the job
+        """
+        self.msg_user(msg)
+        self.report_metrics(metrics)
+
+    def show_status(self, text):
+        """ Shows a running task's progress in the QGIS status bar """
+
+        self.iface.statusBarIface().showMessage(text, 5000)
+
     def msg_user(self, msg):
         """
         Alerts user (iface.messageBar)
@@ -444,6 +360,9 @@ class GatherConnector:
             self.next_tab()
             self.set_btns_enabled(True)
             return Message("Welcome", str(self.dlg.emailInput.toPlainText()), Qgis.Success)
+        except (FetchError, CircuitOpenError, OSError) as ex:
+            self.set_btns_enabled(False, include_login_btn=True)
+            return Message("Error", "Login failed: "+str(ex), Qgis.Warning)
         except:
             self.set_btns_enabled(False, include_login_btn=True)
             return Message("Error", "Login failed: "+str(project_list['error']), Qgis.Warning)
@@ -486,12 +405,90 @@ class GatherConnector:
         # remove old layers
         for layer in QgsProject.instance().mapLayersByName(layer_name):
             QgsProject.instance().removeMapLayer(layer.id())
+        if file.endswith('.vrt'):
+            # the new shards are staged until the old layers no longer hold them open
+            install_shards(file)
 
         # load to qgis
+        layers = []
         geom_types = ['|geometrytype=LineString', '|geometrytype=Polygon', '|geometrytype=Point']
+        if file.endswith('.vrt'):
+            geom_types = ['|layername=' + name for name in LAYER_NAMES]
         for gtype in geom_types:
             vlayer = QgsVectorLayer(file+gtype, layer_name, "ogr")
             QgsProject.instance().addMapLayer(vlayer)
+            layers.append(vlayer)
+        return layers
+
+    def add_attachment_action(self, layers, selected_project, image_folder=None):
+        """
+        Adds an "Open files" feature action which fetches full resolution files on demand,
+        and a map tip showing the feature's images
+
+        @param layers: project layers
+        @param selected_project: project name
+        @param image_folder: folder holding the images (or their thumbnails) to show in map tips
+        """
+        code = (
+            "from qgis.utils import plugins\n"
+            f'plugins[{os.path.basename(self.plugin_dir)!r}].open_attachments({selected_project!r}, r"""[% to_json("files") %]""")'
+        )
+        tip = None
+        if image_folder:
+            url = QUrl.fromLocalFile(image_folder + "/").toString(QUrl.FullyEncoded).replace("'", "%27")
+            extensions = "|".join(ext.lstrip(".") for ext in IMAGE_EXTENSIONS)
+            tip = (
+                "[% array_to_string(array_foreach("
+                f"array_filter(\"files\", regexp_match(lower(map_get(@element, 'name')), '[.]({extensions})$')), "
+                f"'<img src=\"{url}' || map_get(@element, 'name') || '\" width=\"{THUMBNAIL_SIZE}\">'), '') %]"
+            )
+        for layer in layers:
+            if layer.isValid() and layer.fields().indexOf("files") != -1:
+                layer.actions().addAction(QgsAction(QgsAction.GenericPython, "Open files", code))
+                if tip:
+                    layer.setMapTipTemplate(tip)
+
+    def open_attachments(self, selected_project, files):
+        """
+        Opens the files of a feature, downloading originals not yet in the project folder
+
+        @param selected_project: project name
+        @param files: json list of feature files, as stored in the layer
+        """
+        if self.gather_cloud is None:
+            self.msg_user(Message("Error", "Log in first", Qgis.Warning))
+            return
+        folder = self.get_local_project_folder()
+        if not folder:
+            self.msg_user(Message("Error", "Project folder doesn't exist!", Qgis.Warning))
+            return
+        try:
+            value = json.loads(files)
+            if isinstance(value, str):
+                # text columns hold the json list itself
+                value = json.loads(value)
+            names = [f['name'] for f in value]
+        except (ValueError, TypeError, KeyError):
+            self.msg_user(Message("Oops", "feature has no files", Qgis.Warning))
+            return
+        self.set_btns_enabled(False)
+        self.task_manager.run_thread(
+            task=lambda job: [self.gather_cloud.fetch_original(selected_project, folder, name) for name in names],
+            handle_result=self.handle_attachments_fetched,
+            description=f"Fetching {len(names)} files of {selected_project}"
+        )
+
+    def handle_attachments_fetched(self, result):
+        """
+        Opens fetched files with their default application
+
+        @param result: [local paths] or a failure Message
+        """
+        if isinstance(result, Message):
+            self.msg_user(result)
+            return
+        for path in result:
+            QDesktopServices.openUrl(QUrl.fromLocalFile(path))
 
     def handle_load_project(self):
         """ Fetches project selected in the dropdown and loads into QGIS """
@@ -502,18 +499,78 @@ class GatherConnector:
             self.msg_user(Message("Error", "Project folder doesn't exist!", Qgis.Warning))
             return
         project_file_path = project_local_folder + '/' + selected_project + '.geojson'
+        fmt = FORMATS[self.dlg.formatDropdown.currentIndex()]
+        if fmt in STREAM_FORMATS and not driver_available(fmt):
+            self.msg_user(Message("Error", f"GDAL in this QGIS can't write {fmt} files", Qgis.Warning))
+            return
         self.log(f"loading project {selected_project} to {project_file_path}")
         self.set_btns_enabled(False)
-        self.task_manager.run_thread(
-            task=lambda: self.gather_cloud.download_project(
-                selected_project=selected_project,
-                dwnld_path=project_file_path
-            ),
-            handle_result=lambda result: self.add_to_qgis(*result)
-        )
+        metrics = self.gather_cloud.start_job(f"load {selected_project}")
+        if self.dlg.filesCheckBox.isChecked():
+            # files download whilst the project streams in, the layer loads as soon as it's written
+            preview = self.dlg.previewCheckBox.isChecked()
+            self.task_manager.run_thread(
+                task=lambda job: self.gather_cloud.sync_project(
+                    selected_project=selected_project,
+                    folder=project_local_folder,
+                    fmt=fmt,
+                    preview=preview,
+                    on_project=job.stage.emit,
+                    cancel=job.token,
+                    progress=job.report
+                ),
+                handle_result=lambda msg: self.handle_job_finished(msg, metrics),
+                handle_stage=lambda result: self.load_project(
+                    result, metrics, self.image_folder(project_local_folder, selected_project, preview)
+                ),
+                description=f"Loading {selected_project} and its files"
+            )
+        else:
+            self.task_manager.run_thread(
+                task=lambda job: self.gather_cloud.download_project(
+                    selected_project=selected_project,
+                    dwnld_path=project_file_path,
+                    fmt=fmt,
+                    cancel=job.token,
+                    progress=job.report
+                ),
+                handle_result=lambda result: self.handle_project_downloaded(result, metrics),
+                description=f"Loading {selected_project}"
+            )
 
         self.msg_user(Message("Loading", selected_project, Qgis.Success))
 
+    def load_project(self, result, metrics, image_folder=None):
+        """
+        Loads a downloaded project into QGIS
+
+        @param result: (project name, download path)
+        @param metrics: JobMetrics of the download
+        @param image_folder: folder of the project's images (or thumbnails) for map tips
+        """
+        with metrics.timed('layer', 'load'):
+            layers = self.add_to_qgis(*result)
+        self.add_attachment_action(layers, result[0], image_folder)
+
+    @staticmethod
+    def image_folder(folder, selected_project, preview):
+        """ @return: where images of a project are placed, thumbnails when previewing """
+        project_folder = folder + "/" + selected_project
+        return project_folder + "/" + THUMBNAIL_FOLDER if preview else project_folder
+
+    def handle_project_downloaded(self, result, metrics):
+        """
+        Loads a downloaded project into QGIS
+
+        @param result: (project name, download path) or a failure Message
+        @param metrics: JobMetrics of the download
+        """
+        if isinstance(result, Message):
+            self.msg_user(result)
+        else:
+            self.load_project(result, metrics)
+        self.report_metrics(metrics)
+
     def handle_add_layer_to_project(self):
         """ Adds selected (dropdown) layer to selected (dropdown) project """
 
@@ -538,18 +595,49 @@ class GatherConnector:
             self.set_btns_enabled(True)
             return
 
-        exp = QgsJsonExporter(layer)
-        fc = json.loads(exp.exportFeatures(layer.getFeatures()))
-        self.task_manager.run_thread(
-            task=lambda: self.gather_cloud.add_fc_to_project(
-                project_name=str(self.dlg.projectDropdown.currentText()),
+        metrics = self.gather_cloud.start_job(f"upload {layer.name()}")
+        options = UploadOptions(
+            precision=self.dlg.precisionSpinBox.value(),
+            tolerance=self.dlg.toleranceSpinBox.value(),
+            drop_zm=self.dlg.dropZMCheckBox.isChecked()
+        )
+        project_name = str(self.dlg.projectDropdown.currentText())
+        layer_name = str(self.dlg.layerDropdown.currentText())
+        # the task reads a snapshot of the layer, QgsVectorLayer itself must stay on the main thread
+        source = QgsVectorLayerFeatureSource(layer)
+        exporter = layer_exporter(layer, options)
+        fields = layer_fields(layer)
+        total = layer.featureCount()
+
+        def upload(job):
+            with metrics.timed('layer', 'encode'):
+                fc, report = export_layer(
+                    source, exporter, layer_name, options, total, cancel=job.token, progress=job.report
+                )
+                form = infer_layer_form(source, layer_name, fields)
+            job.stage.emit(report)
+            return self.gather_cloud.add_fc_to_project(
+                project_name=project_name,
                 project_id=project_id,
-                layer_name=str(self.dlg.layerDropdown.currentText()),
-                fc=fc
-            ),
-            handle_result=lambda message: self.msg_user(message)
+                layer_name=layer_name,
+                fc=fc,
+                form=form,
+                cancel=job.token,
+                progress=job.report
+            )
+
+        self.task_manager.run_thread(
+            task=upload,
+            handle_result=lambda message: self.handle_job_finished(message, metrics),
+            handle_stage=self.handle_layer_prepared,
+            description=f"Uploading {layer.name()}"
         )
 
+    def handle_layer_prepared(self, report):
+        """ @param report: size reduction report of export_layer """
+        self.log(report)
+        self.msg_user(Message("Prepared", report, Qgis.Info))
+
     def select_folder(self):
         """ Folder path selection dialog """
         folderpath = QFileDialog.getExistingDirectory(self.dlg, 'Select Local Project Folder')
@@ -567,6 +655,7 @@ class GatherConnector:
         self.dlg.refreshProjectButton.setEnabled(state)
         self.dlg.addLayerButton.setEnabled(state)
         self.dlg.folderButton.setEnabled(state)
+        self.dlg.cleanStoreButton.setEnabled(state)
         self.dlg.projectDropdown.setEnabled(state)
         self.dlg.layerDropdown.setEnabled(state)
 
@@ -575,14 +664,38 @@ class GatherConnector:
 
         selected_project = str(self.dlg.projectDropdown.currentText())
         folder = self.get_local_project_folder()
+        preview = self.dlg.previewCheckBox.isChecked()
         self.msg_user(Message("Downloading files", selected_project))
         self.set_btns_enabled(False)
+        metrics = self.gather_cloud.start_job(f"files {selected_project}")
         self.task_manager.run_thread(
-            task=lambda: self.gather_cloud.download_project_files(
+            task=lambda job: self.gather_cloud.download_project_files(
                 selected_project=selected_project,
-                folder=folder
+                folder=folder,
+                preview=preview,
+                cancel=job.token,
+                progress=job.report
             ),
-            handle_result=lambda msg: self.msg_user(msg)
+            handle_result=lambda msg: self.handle_job_finished(msg, metrics),
+            description=f"Downloading files of {selected_project}"
+        )
+
+    def handle_collect_garbage(self):
+        """ Removes files in the local store no longer used by any project """
+
+        folder = self.get_local_project_folder()
+        if not folder:
+            self.msg_user(Message("Error", "Project folder doesn't exist!", Qgis.Warning))
+            return
+        self.set_btns_enabled(False)
+        self.task_manager.run_thread(
+            task=lambda job: BlobStore(folder).collect_garbage(),
+            handle_result=lambda result: self.msg_user(result if isinstance(result, Message) else Message(
+                "Cleaned",
+                f"removed {str(result[0])} unused files ({str(result[1] // 1024)} KB)",
+                Qgis.Success
+            )),
+            description="Cleaning file store"
         )
 
     def run(self):
@@ -593,6 +706,7 @@ class GatherConnector:
         if self.first_start:
             self.first_start = False
             self.dlg = GatherConnectorDialog()
+            self.dlg.finished.connect(self.task_manager.cancel)
             self.set_btns_enabled(state=False, include_login_btn=False)
 
         # show the dialog
@@ -602,13 +716,15 @@ class GatherConnector:
             self.prev_tab()
 
         self.dlg.loginButton.clicked.connect(lambda: self.task_manager.run_thread(
-            task=self.login,
-            handle_result=lambda msg: self.msg_user(msg)
+            task=lambda job: self.login(),
+            handle_result=lambda msg: self.msg_user(msg),
+            description="Logging in to Gather"
         ))
         self.dlg.loadProjectButton.clicked.connect(self.handle_load_project)
         self.dlg.downloadButton.clicked.connect(self.handle_download_files)
         self.dlg.addLayerButton.clicked.connect(self.handle_add_layer_to_project)
         self.dlg.refreshLayersButton.clicked.connect(self.refresh_qgis_layers)
         self.dlg.folderButton.clicked.connect(self.select_folder)
+        self.dlg.cleanStoreButton.clicked.connect(self.handle_collect_garbage)
         self.dlg.syncButton.clicked.connect(lambda: self.msg_user(Message("Hold on", "yet to implement")))
 
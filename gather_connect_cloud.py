@@ -0,0 +1,593 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Talks to the Gather API: project downloads, attachment syncing and uploads.
+ Kept free of qgis imports so it can be tested and benchmarked on its own.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+import base64
+import http.client
+import os.path
+import threading
+import time
+
+try:
+    from . import gather_connect_codec as codec
+    from .gather_connect_codec import FeatureSplitter, ProjectReader, feature_manifest
+    from .gather_connect_files import BlobStore, ThumbnailCache, is_image, process_pool
+    from .gather_connect_net import CancelledError, Fetch, JobMetrics, OpMetric, RetryPolicy
+except ImportError:
+    import gather_connect_codec as codec
+    from gather_connect_codec import FeatureSplitter, ProjectReader, feature_manifest
+    from gather_connect_files import BlobStore, ThumbnailCache, is_image, process_pool
+    from gather_connect_net import CancelledError, Fetch, JobMetrics, OpMetric, RetryPolicy
+
+try:
+    try:
+        from .gather_connect_convert import STREAM_FORMATS, StreamWriter, convert
+    except ImportError:
+        from gather_connect_convert import STREAM_FORMATS, StreamWriter, convert
+except ImportError:
+    # GDAL ships with QGIS, without it projects can only be loaded as geojson
+    STREAM_FORMATS, StreamWriter, convert = {}, None, None
+
+try:
+    from qgis.core import Qgis
+    INFO, WARNING, CRITICAL, SUCCESS = Qgis.Info, Qgis.Warning, Qgis.Critical, Qgis.Success
+except ImportError:
+    # the values of Qgis.MessageLevel, for use outside QGIS
+    INFO, WARNING, CRITICAL, SUCCESS = 0, 1, 2, 3
+
+HOST = "eu-west-1.aws.data.mongodb-api.com"
+LIST_PROJECTS_URL = "/app/gatherapplication-mgejo/endpoint/listprojects"
+PROJECT_URL = "/app/gatherapplication-mgejo/endpoint/project?id="
+FEATURE_URL = "/app/gatherapplication-mgejo/endpoint/feature?id="
+GET_FILE_URL = "/app/gatherapplication-mgejo/endpoint/file?name="
+ATTACHMENT_WORKERS = 4
+# download formats, in the order of the options tab formatDropdown
+FORMATS = ('geojson', 'gpkg', 'fgb', 'parquet')
+
+# RetryPolicy per GatherCloud operation. Uploads are not idempotent so only retry when the server refused them
+DEFAULT_POLICIES = {
+    'list': RetryPolicy(read_timeout=30),
+    'project': RetryPolicy(read_timeout=300),
+    'file': RetryPolicy(read_timeout=120),
+    'upload': RetryPolicy(read_timeout=600, retries=2, retry_statuses=(429, 503), idempotent=False),
+}
+
+
+@dataclass
+class Message:
+    """
+    A message to be handled by GatherConnector.msg_user
+    properties are the parameters accepted by:
+    https://api.qgis.org/api/classQgsMessageBar.html#ab018174e31107764e654d50292ef1f3a
+    TODO pass Message direct to QgsMessageBar.pushMessage?
+
+    @param title: gist of it
+    @param text:  main message content
+    @param level: one of:
+        1. Info
+        2. Warning
+        3. Critical
+        4. Success
+    """
+    title: str
+    text: str
+    level: int = INFO
+    duration: int = None
+
+    def __post_init__(self):
+        if self.duration is None:
+            self.duration = 5
+
+    def as_list(self):
+        return [self.title, self.text, self.level, self.duration]
+
+
+@dataclass
+class UploadOptions:
+    """
+    How to shrink a layer before upload
+
+    @param precision: decimal places of coordinates
+    @param tolerance: simplification tolerance in layer units, 0 keeps every vertex
+    @param drop_zm: drop Z and M values
+    """
+    precision: int = 6
+    tolerance: float = 0.0
+    drop_zm: bool = False
+
+    def describe(self):
+        steps = [f"{self.precision} decimals"]
+        if self.tolerance:
+            steps.append(f"simplified to {self.tolerance:g}")
+        if self.drop_zm:
+            steps.append("Z/M dropped")
+        return ", ".join(steps)
+
+
+class FileSync:
+    """
+    Places feature files in a project folder using a pool of threads, fed file lists as features arrive.
+    At most twice ATTACHMENT_WORKERS files are queued, add blocks beyond that so a fast producer
+    doesn't hold a whole project's files in memory.
+    """
+
+    def __init__(self, cloud, selected_project, folder, preview=False, workers=ATTACHMENT_WORKERS, cancel=None,
+                 progress=None):
+        """
+        @param cloud: GatherCloud to fetch with
+        @param selected_project: project name
+        @param folder: download path
+        @param preview: place thumbnails of images in the project folder, keeping originals in the store
+        @param workers: files fetched at once
+        @param cancel: CancelToken
+        @param progress: callback(stage, done, total)
+        """
+        self.cloud = cloud
+        self.cancel = cancel
+        self.progress = progress
+        self.project_folder = folder + "/" + selected_project
+        if not os.path.exists(self.project_folder):
+            os.makedirs(self.project_folder)
+        self.preview = preview
+        self.store = BlobStore(folder)
+        self.thumbnails = ThumbnailCache(self.project_folder) if preview else None
+        self.pool = ThreadPoolExecutor(workers)
+        self.slots = threading.Semaphore(workers * 2)
+        self.seen = set()
+        self.futures = []
+        self.done = 0
+        self.total = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.pool.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+        self.store.save()
+        if self.thumbnails:
+            self.thumbnails.close()
+
+    @property
+    def count(self):
+        """ Distinct files added, a file added again (shared, or replayed by a retried download) counts once """
+        return len(self.seen)
+
+    def add(self, files):
+        """ @param files: [file dicts] of a feature, files already added are skipped """
+        for file in files:
+            if file['name'] in self.seen:
+                continue
+            self.seen.add(file['name'])
+            self.slots.acquire()
+            future = self.pool.submit(self.sync, file['name'])
+            future.add_done_callback(self.on_done)
+            self.futures.append(future)
+
+    def on_done(self, _):
+        self.slots.release()
+        with self.lock:
+            self.done += 1
+            done = self.done
+        if self.progress:
+            self.progress('files', done, self.total)
+
+    def sync(self, name):
+        """ @return: True if the file was fetched """
+        if self.preview and is_image(name):
+            # originals are kept in the store, so fetch_original places them without downloading them again.
+            # They are kept for as long as their thumbnail, which ThumbnailCache bounds
+            fetched = name not in self.store
+            if fetched:
+                data = self.cloud.fetch_file(name, self.cancel)
+                with self.cloud.metrics.timed('file', 'write', len(data)):
+                    self.store.put(name, data)
+            self.store.reference(name, self.thumbnails.path(name))
+            if name in self.thumbnails:
+                self.thumbnails.touch(name)
+            else:
+                self.thumbnails.add(name, data if fetched else self.store.read(name))
+            return fetched
+        return self.cloud.store_file(self.store, name, self.project_folder + "/" + name, self.cancel)
+
+    def fetched(self):
+        """
+        Waits for queued files, raising the first failure
+
+        @return: number of files fetched
+        """
+        self.total = len(self.futures)
+        return sum(future.result() for future in self.futures)
+
+
+class GatherCloud:
+    """ Manages calls to the API """
+
+    def __init__(self, email, password, host=HOST, secure=True, policies=None):
+        """
+        @param email: Gather login
+        @param password: Gather password
+        @param host: API host, optionally with port
+        @param secure: use https
+        @param policies: RetryPolicy per operation, overriding DEFAULT_POLICIES
+        """
+        self.email = email
+        self.password = password
+        self.host = host
+        self.secure = secure
+        self.policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self.project_list = []
+        self.metrics = JobMetrics("session")
+
+    def start_job(self, job):
+        """
+        Starts collecting timings for a new job
+
+        @param job: description of the job
+        @return: JobMetrics of the job
+        """
+        self.metrics = JobMetrics(job)
+        return self.metrics
+
+    def fetch(self, operation, url, stream=False, **kwargs):
+        """
+        Requests url from the API with the operation's RetryPolicy
+
+        @param operation: key of self.policies
+        @param url: path and query
+        @param stream: return the response unread, to be read with Fetch.chunks
+        @return: response body bytes, or the response when streaming
+        """
+        headers = {
+            'email': self.email,
+            'password': self.password,
+            **kwargs.pop('headers', {})
+        }
+        return (Fetch.request if stream else Fetch.fetch)(
+            host=self.host,
+            url=url,
+            headers=headers,
+            policy=self.policies[operation],
+            secure=self.secure,
+            metrics=self.metrics,
+            operation=operation,
+            **kwargs
+        )
+
+    def fetch_project_list(self):
+        """
+        lists Gather projects available to user
+
+        @return: [projects]
+        """
+        data = self.fetch('list', LIST_PROJECTS_URL)
+        with self.metrics.timed('list', 'decode', len(data)):
+            self.project_list = codec.loads(data)
+        return self.project_list
+
+    def fetch_project(self, selected_project):
+        """
+        Fetches project geojson
+
+        @param selected_project: Project to fetch
+        @return: project geojson
+        """
+        data = self.fetch('project', PROJECT_URL + self.project_id(selected_project))
+        with self.metrics.timed('project', 'decode', len(data)):
+            project_data = codec.loads(data)
+
+        return project_data
+
+    def fetch_manifest(self, selected_project, cancel=None):
+        """
+        Streams a project, yielding each feature's files as soon as it arrives.
+        Only one feature is held decoded at a time.
+
+        @param selected_project: project name
+        @param cancel: CancelToken
+        @return: generator of (feature id, [file dicts])
+        """
+        res = self.fetch('project', PROJECT_URL + self.project_id(selected_project), stream=True, cancel=cancel)
+        for raw in FeatureSplitter().feed(Fetch.chunks(res)):
+            yield feature_manifest(raw)
+
+    def project_id(self, selected_project):
+        """
+        @param selected_project: project name
+        @return: project id
+        """
+        return [p['id'] for p in self.project_list if p['name'] == selected_project][0]
+
+    def fetch_file(self, name, cancel=None):
+        """
+        Fetches a file attached to a feature
+
+        @param name: file name
+        @param cancel: CancelToken
+        @return: file bytes
+        """
+        data = self.fetch('file', GET_FILE_URL + name, cancel=cancel)
+        with self.metrics.timed('file', 'decode', len(data)):
+            return base64.b64decode(data)
+
+    def store_file(self, store, name, dest, cancel=None):
+        """
+        Places a file at dest, only fetching it if it is not in the local store yet
+
+        @param store: BlobStore of the download folder
+        @param name: file name
+        @param dest: local path
+        @param cancel: CancelToken
+        @return: True if the file was fetched
+        """
+        fetched = name not in store
+        if fetched:
+            data = self.fetch_file(name, cancel)
+            with self.metrics.timed('file', 'write', len(data)):
+                store.put(name, data)
+        with self.metrics.timed('file', 'write'):
+            store.link(name, dest)
+        return fetched
+
+    def fetch_original(self, selected_project, folder, name):
+        """
+        Places a full resolution file in the project folder, only downloading it if it is not in the store
+        (files previewed are kept there)
+
+        @param selected_project: project name
+        @param folder: download path
+        @param name: file name
+        @return: local path to file
+        """
+        project_local_folder = folder + "/" + selected_project
+        path = project_local_folder + "/" + name
+        if not os.path.exists(path):
+            if not os.path.exists(project_local_folder):
+                os.makedirs(project_local_folder)
+            with BlobStore(folder) as store:
+                self.store_file(store, name, path)
+        return path
+
+    def project_files(self, selected_project, cached=None, cancel=None):
+        """
+        Files attached to each feature, streamed from the manifest. A project file on disk may be
+        out of date, so it is only read when the caller knows it is current, e.g. one download_project
+        just wrote in the same job.
+
+        @param selected_project: project name
+        @param cached: path to a current project geojson to read instead of fetching
+        @param cancel: CancelToken
+        @return: generator of [file dicts] per feature
+        """
+        if cached:
+            with ProjectReader(cached) as reader:
+                for i in range(len(reader)):
+                    yield reader.files(i)
+            return
+        for _, files in self.fetch_manifest(selected_project, cancel):
+            yield files
+
+    def download_project_files(self, selected_project, folder, preview=False, cached=None, cancel=None,
+                               progress=None):
+        """
+        Downloads files associated with features in a project
+
+        @param selected_project: project name
+        @param folder: download path
+        @param preview: place thumbnails of images in the project folder, originals are placed by fetch_original when opened
+        @param cached: path to a current project geojson, see project_files
+        @param cancel: CancelToken
+        @param progress: callback(stage, done, total)
+        @return: Success/Fail Message
+        """
+        if not folder:
+            return Message("Error", "Project folder doesn't exist!", WARNING)
+        with FileSync(self, selected_project, folder, preview, cancel=cancel, progress=progress) as sync:
+            for files in self.project_files(selected_project, cached, cancel):
+                sync.add(files)
+            fetched = sync.fetched()
+        return self.files_message(sync.count, fetched, preview)
+
+    @staticmethod
+    def files_message(count, fetched, preview):
+        return Message(
+            "Success",
+            f"{str(count)} files {'previewed' if preview else 'downloaded'} ({str(fetched)} fetched)",
+            SUCCESS
+        )
+
+    def sync_project(self, selected_project, folder, fmt='geojson', preview=False, on_project=None, cancel=None,
+                     progress=None):
+        """
+        Downloads a project and its files in one pass. Files are fetched as their features arrive,
+        whilst the rest of the project is still downloading, and the layer can be loaded
+        before the last files are in.
+
+        @param selected_project: project name
+        @param folder: download path
+        @param fmt: one of FORMATS
+        @param preview: place thumbnails of images in the project folder instead of originals
+        @param on_project: called with (project name, path of the file to load) once the project is written
+        @param cancel: CancelToken
+        @param progress: callback(stage, done, total)
+        @return: Success/Fail Message
+        """
+        if not folder:
+            return Message("Error", "Project folder doesn't exist!", WARNING)
+        with FileSync(self, selected_project, folder, preview, cancel=cancel, progress=progress) as sync:
+            path = self.stream_project(
+                selected_project, folder + "/" + selected_project + ".geojson", fmt, sync.add, cancel, progress
+            )
+            if on_project:
+                on_project((selected_project, path))
+            fetched = sync.fetched()
+        return self.files_message(sync.count, fetched, preview)
+
+    def download_project(self, selected_project, dwnld_path, fmt='geojson', cancel=None, progress=None):
+        """
+        Downloads a project as geojson
+
+        @param selected_project: project name
+        @param dwnld_path: path to geojson file
+        @param fmt: one of FORMATS, gpkg also converts the geojson to GeoPackage shards in parallel,
+            fgb and parquet are written whilst the geojson downloads
+        @param cancel: CancelToken
+        @param progress: callback(stage, done, total)
+        @return: (project name, path of the file to load)
+        """
+        return selected_project, self.stream_project(selected_project, dwnld_path, fmt, None, cancel, progress)
+
+    def stream_project(self, selected_project, dwnld_path, fmt='geojson', on_files=None, cancel=None, progress=None):
+        """
+        Writes a project to disk feature by feature as it downloads, never holding the whole
+        project in memory. fgb and parquet are written alongside the geojson as features arrive,
+        gpkg is converted from it once complete. Nothing is left behind if it fails or is cancelled.
+        A download cut off by a reset or timeout is started again from scratch, with the project's
+        RetryPolicy, so features already seen are passed to on_files again.
+
+        @param selected_project: project name
+        @param dwnld_path: path to geojson file
+        @param fmt: one of FORMATS
+        @param on_files: called with each feature's [file dicts] as the feature arrives, e.g. FileSync.add
+            which skips files it already has
+        @param cancel: CancelToken
+        @param progress: callback(stage, done, total)
+        @return: path of the file to load, for gpkg the vrt is only in place once install_shards is called
+        """
+        dest = dwnld_path
+        if fmt in STREAM_FORMATS:
+            dest = os.path.splitext(dwnld_path)[0] + STREAM_FORMATS[fmt][1]
+        policy = self.policies['project']
+        sleep = cancel.wait if cancel else time.sleep
+
+        # network time and waits on FileSync are left out, only writing and converting are timed
+        metric = OpMetric('project')
+
+        part = dwnld_path + ".part"
+        try:
+            with open(part, 'wb') as raw:
+                for attempt in range(policy.retries + 1):
+                    raw.seek(0)
+                    raw.truncate()
+                    metric.bytes_received = 0
+                    res = self.fetch('project', PROJECT_URL + self.project_id(selected_project), stream=True,
+                                     cancel=cancel)
+                    try:
+                        with (StreamWriter(dest, fmt) if fmt in STREAM_FORMATS else nullcontext()) as writer:
+                            self.write_project(res, raw, writer, metric, on_files, progress)
+                        break
+                    except (ConnectionError, TimeoutError, http.client.HTTPException):
+                        if cancel:
+                            cancel.check()
+                        if attempt == policy.retries:
+                            raise
+                    sleep(policy.delay(attempt))
+            os.replace(part, dwnld_path)
+        finally:
+            self.metrics.record(metric)
+            if os.path.exists(part):
+                os.remove(part)
+        if cancel:
+            cancel.check()
+        if fmt == 'gpkg':
+            with self.metrics.timed('project', 'convert', metric.bytes_received), process_pool() as pool:
+                dest, _ = convert(dwnld_path, pool, cancel=cancel)
+        return dest
+
+    @staticmethod
+    def write_project(res, raw, writer, metric, on_files=None, progress=None):
+        """
+        Reads one attempt at downloading a project, see stream_project
+
+        @param res: streamed project response
+        @param raw: file the geojson is written to
+        @param writer: StreamWriter, or None
+        @param metric: OpMetric to time writing and converting in
+        @param on_files: called with each feature's [file dicts]
+        @param progress: callback(stage, done, total)
+        """
+        total = int(res.getheader('Content-Length') or 0) or None
+
+        def tee(chunks):
+            done = 0
+            for chunk in chunks:
+                with metric.timing('write'):
+                    raw.write(chunk)
+                done += len(chunk)
+                if progress:
+                    progress('project', done, total)
+                yield chunk
+
+        for feature in FeatureSplitter().feed(tee(Fetch.chunks(res))):
+            metric.bytes_received += len(feature)
+            if on_files:
+                on_files(feature_manifest(feature)[1])
+            if writer:
+                with metric.timing('convert'):
+                    writer.add(codec.loads(feature))
+        if writer:
+            with metric.timing('convert'):
+                writer.close()
+
+    def add_fc_to_project(self, project_name, layer_name, project_id, fc, form=None, cancel=None, progress=None):
+        """
+        Adds a featureclass to a project
+
+        @param project_name: project to which you wish to add a layer
+        @param layer_name: name of layer to add
+        @param project_id: id of project to add layer to
+        @param fc: geojson featureclass of the layer being added, as a dict or an already encoded str
+        @param form: form schema from infer_form, sent so the server needn't infer types from every value
+        @param cancel: CancelToken
+        @param progress: callback(stage, done, total)
+        @return: Success/fail Message
+        """
+        try:
+            with self.metrics.timed('upload', 'encode'):
+                geojson = fc.encode() if isinstance(fc, str) else codec.dumpb(fc)
+                payload = b'{"name": ' + codec.dumpb(layer_name) + b', "geojson": ' + geojson
+                if form is not None:
+                    payload += b', "form": ' + codec.dumpb(form)
+                payload += b'}'
+            if progress:
+                progress('upload', 0, len(payload))
+            res = self.fetch('upload', FEATURE_URL + project_id, verb="POST", payload=payload, headers={
+                'Content-Type': 'application/json'
+            }, cancel=cancel)
+            if progress:
+                progress('upload', len(payload), len(payload))
+            result = codec.loads(res)
+        except CancelledError:
+            raise
+        except Exception as ex:
+            return Message('Failed', str(ex), CRITICAL)
+        if result['success']:
+            return Message(
+                "Success",
+                f"Added {str(result['featureCount'])} features and {str(result['formCount'])} forms to {project_name}",
+                SUCCESS
+            )
+        else:
+            return Message("Failed", str(result['error']), CRITICAL)
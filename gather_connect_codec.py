@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ JSON encoding and decoding. Uses orjson or msgspec when installed, the
+ standard library otherwise. Set GATHER_JSON_BACKEND to force a backend.
+ FeatureSplitter finds feature boundaries in FeatureCollection bytes without decoding them,
+ ProjectReader uses them to read single features of a downloaded project through a memory map.
+"""
+from array import array
+from dataclasses import dataclass
+from mmap import mmap, ACCESS_READ
+import json
+import os
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+@dataclass
+class Codec:
+    """
+    A JSON backend
+
+    @param name: backend name
+    @param loads: bytes or str -> object
+    @param dumpb: object -> utf-8 bytes
+    """
+    name: str
+    loads: callable
+    dumpb: callable
+
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+
+def _stdlib_dumpb(obj):
+    return json.dumps(obj, ensure_ascii=False).encode()
+
+
+CODECS = {'json': Codec('json', _stdlib_loads, _stdlib_dumpb)}
+if msgspec is not None:
+    CODECS['msgspec'] = Codec('msgspec', msgspec.json.decode, msgspec.json.encode)
+if orjson is not None:
+    CODECS['orjson'] = Codec('orjson', orjson.loads, orjson.dumps)
+
+PREFERENCE = ('orjson', 'msgspec', 'json')
+
+codec = None
+
+
+def use(name=None):
+    """
+    Selects the backend used by loads/dumps
+
+    @param name: backend name, defaults to GATHER_JSON_BACKEND or the fastest installed
+    @return: the Codec now in use
+    """
+    global codec
+    name = name or os.environ.get('GATHER_JSON_BACKEND')
+    if name:
+        if name not in CODECS:
+            raise ValueError(f"JSON backend {name} is not installed, choose from {', '.join(CODECS)}")
+        codec = CODECS[name]
+    else:
+        codec = next(CODECS[n] for n in PREFERENCE if n in CODECS)
+    return codec
+
+
+def loads(data):
+    """
+    @param data: JSON as bytes or str
+    @return: decoded object
+    """
+    return codec.loads(data)
+
+
+def dumpb(obj):
+    """
+    @param obj: object to encode
+    @return: JSON as utf-8 bytes
+    """
+    return codec.dumpb(obj)
+
+
+def dumps(obj):
+    """
+    @param obj: object to encode
+    @return: JSON str
+    """
+    return codec.dumpb(obj).decode()
+
+
+use()
+
+
+_STRUCT = re.compile(rb'[{}"]')
+_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"', re.S)
+_FEATURES = re.compile(rb'"features"\s*:\s*\[')
+_NEXT = re.compile(rb'[\s,]*([{\]])')
+_PENDING = re.compile(rb'[\s,:]*')
+_OPEN, _QUOTE = ord('{'), ord('"')
+
+
+class FeatureSplitter:
+    """
+    Finds the byte span of each feature in a FeatureCollection without decoding it.
+    Only braces and strings are scanned (with regexes), coordinates are skipped over,
+    so it runs far faster than a JSON parser. Works on whole buffers (bytes, mmap) or fed chunk by chunk.
+    """
+
+    def __init__(self):
+        self.state = 'head'
+        self.depth = 0
+        self.start = None
+
+    def scan(self, buf, pos=0):
+        """
+        Yields (start, end) of each complete feature in buf from pos.
+        Afterwards self.pos is where scanning stopped, waiting for more data.
+
+        @param buf: bytes-like FeatureCollection, or the start of one
+        @param pos: offset to resume from
+        """
+        size = len(buf)
+        while self.state != 'done':
+            if self.state == 'between':
+                m = _NEXT.match(buf, pos)
+                if not m:
+                    if _PENDING.fullmatch(buf, pos):
+                        break
+                    raise ValueError(f"expected a feature at byte {pos}")
+                if buf[m.start(1)] != _OPEN:
+                    self.state = 'done'
+                    pos = m.end()
+                    break
+                self.start = m.start(1)
+                self.depth = 2
+                self.state = 'feature'
+                pos = m.end()
+                continue
+
+            m = _STRUCT.search(buf, pos)
+            if not m:
+                pos = size
+                break
+            char = buf[m.start()]
+            if char == _QUOTE:
+                string = _STRING.match(buf, m.start())
+                if not string:
+                    pos = m.start()
+                    break
+                if self.state == 'head' and self.depth == 1 and buf[m.start():string.end()] == b'"features"':
+                    key = _FEATURES.match(buf, m.start())
+                    if key:
+                        self.state = 'between'
+                        pos = key.end()
+                        continue
+                    if _PENDING.fullmatch(buf, string.end()):
+                        pos = m.start()
+                        break
+                pos = string.end()
+            elif char == _OPEN:
+                self.depth += 1
+                pos = m.end()
+            else:
+                self.depth -= 1
+                pos = m.end()
+                if self.state == 'feature' and self.depth == 1:
+                    self.state = 'between'
+                    yield self.start, pos
+        self.pos = pos
+
+    @staticmethod
+    def spans(buf):
+        """
+        @param buf: bytes-like FeatureCollection
+        @return: generator of (start, end) byte offsets of its features
+        """
+        return FeatureSplitter().scan(buf)
+
+    def feed(self, chunks):
+        """
+        Splits a FeatureCollection arriving in chunks
+
+        @param chunks: iterable of bytes
+        @return: generator of raw feature bytes
+        """
+        buf = b''
+        pos = 0
+        for chunk in chunks:
+            buf += chunk
+            for start, end in self.scan(buf, pos):
+                yield buf[start:end]
+            # drop what is consumed, keeping the feature in progress
+            keep = self.start if self.state == 'feature' else self.pos
+            buf = buf[keep:]
+            pos = self.pos - keep
+            if self.start is not None:
+                self.start -= keep
+        if self.state != 'done':
+            raise ValueError("FeatureCollection ended early")
+
+
+def shard_spans(spans, shards):
+    """
+    Groups consecutive feature spans into byte ranges
+
+    @param spans: list of (start, end)
+    @param shards: number of ranges wanted
+    @return: [(start, end, feature count)]
+    """
+    if not spans:
+        return []
+    per_shard = -(-len(spans) // shards)
+    return [
+        (spans[i][0], spans[min(i + per_shard, len(spans)) - 1][1], min(per_shard, len(spans) - i))
+        for i in range(0, len(spans), per_shard)
+    ]
+
+
+def loads_features(data):
+    """
+    Decodes a byte range of comma separated features, as grouped by shard_spans
+
+    @param data: bytes from the start of one feature to the end of another
+    @return: [features]
+    """
+    return loads(b'[' + data + b']')
+
+
+def feature_manifest(raw):
+    """
+    Id and attached files of a feature. Decoding the whole feature with loads is faster
+    than scanning past its geometry in python, see bench_connect.py codec manifest
+
+    @param raw: JSON bytes of one feature
+    @return: (id or None, [file dicts])
+    """
+    feature = loads(raw)
+    return feature.get('id'), (feature.get('properties') or {}).get('files') or []
+
+
+class ProjectReader:
+    """
+    Random access to the features of a downloaded FeatureCollection. The file is memory mapped
+    and indexed by feature byte offsets, so only the features asked for are ever decoded and
+    memory use stays flat however large the project. The index is saved next to the file and
+    rebuilt when the file changes.
+    """
+
+    def __init__(self, path, index_path=None):
+        """
+        @param path: project geojson
+        @param index_path: where to keep the index, defaults to a hidden file next to path
+        """
+        self.path = path
+        self.index_path = index_path or os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.idx')
+        self.file = open(path, 'rb')
+        try:
+            self.mm = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError(f"{path} is empty")
+        self.offsets = self.load_index()
+        if self.offsets is None:
+            self.offsets = self.build_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def __iter__(self):
+        return (self.feature(i) for i in range(len(self)))
+
+    def stamp(self):
+        stat = os.fstat(self.file.fileno())
+        return array('Q', [stat.st_size, stat.st_mtime_ns])
+
+    def load_index(self):
+        """ @return: offsets from the saved index, None if missing or out of date """
+        index = array('Q')
+        try:
+            with open(self.index_path, 'rb') as f:
+                index.frombytes(f.read())
+        except (OSError, ValueError):
+            return None
+        if len(index) % 2 or index[:2] != self.stamp():
+            return None
+        return index[2:]
+
+    def build_index(self):
+        """ @return: [start, end, start, end...] of every feature """
+        offsets = array('Q')
+        for start, end in FeatureSplitter.spans(self.mm):
+            offsets.append(start)
+            offsets.append(end)
+        try:
+            with open(self.index_path + '.tmp', 'wb') as f:
+                f.write(self.stamp().tobytes())
+                f.write(offsets.tobytes())
+            os.replace(self.index_path + '.tmp', self.index_path)
+        except OSError:
+            pass  # read only folder, keep the index in memory
+        return offsets
+
+    def span(self, i):
+        """ @return: (start, end) byte offsets of feature i """
+        return self.offsets[2 * i], self.offsets[2 * i + 1]
+
+    def raw(self, i):
+        """ @return: JSON bytes of feature i """
+        start, end = self.span(i)
+        return self.mm[start:end]
+
+    def feature(self, i):
+        """ @return: feature i decoded """
+        return loads(self.raw(i))
+
+    def files(self, i):
+        """ @return: [file dicts] attached to feature i """
+        return feature_manifest(self.raw(i))[1]
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
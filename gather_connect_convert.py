@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Converts a downloaded project GeoJSON into spatially indexed GeoPackage shards,
+ parsed, validated and written in parallel by a process pool, then unioned by
+ an OGR VRT which QGIS loads as one layer per geometry type.
+ StreamWriter instead writes FlatGeobuf or GeoParquet as features are parsed off the wire.
+"""
+from concurrent.futures import FIRST_COMPLETED, wait
+from mmap import mmap, ACCESS_READ
+import os
+import shutil
+from xml.sax.saxutils import escape
+
+from osgeo import ogr, osr
+
+try:
+    from .gather_connect_codec import FeatureSplitter, dumps, loads_features, shard_spans
+except ImportError:
+    from gather_connect_codec import FeatureSplitter, dumps, loads_features, shard_spans
+
+# layers in the order add_to_qgis stacks them
+LAYER_NAMES = ('lines', 'polygons', 'points')
+LAYER_TYPES = {'points': ogr.wkbMultiPoint, 'lines': ogr.wkbMultiLineString, 'polygons': ogr.wkbMultiPolygon}
+FAMILIES = {
+    ogr.wkbPoint: 'points', ogr.wkbMultiPoint: 'points',
+    ogr.wkbLineString: 'lines', ogr.wkbMultiLineString: 'lines',
+    ogr.wkbPolygon: 'polygons', ogr.wkbMultiPolygon: 'polygons',
+}
+FORCE_MULTI = {'points': ogr.ForceToMultiPoint, 'lines': ogr.ForceToMultiLineString, 'polygons': ogr.ForceToMultiPolygon}
+ID_FIELD = 'feature_id'
+EXTRA_FIELD = 'extra_properties'
+MIN_SHARD_FEATURES = 2000
+SCHEMA_SAMPLE = 1000
+# seconds between checks for cancellation whilst waiting on shards
+CANCEL_POLL = 0.2
+# shards are converted into <name>_layers.new, with the vrt, and moved in place by install_shards
+SHARD_SUFFIX = '_layers'
+STAGED_SUFFIX = '.new'
+STAGED_VRT = 'project.vrt'
+# format: (OGR driver, file extension, layer creation options)
+STREAM_FORMATS = {
+    'fgb': ('FlatGeobuf', '.fgb', ['SPATIAL_INDEX=YES']),
+    'parquet': ('Parquet', '.parquet', ['GEOMETRY_ENCODING=WKB', 'SORT_BY_BBOX=YES']),
+}
+
+
+def value_type(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    return 'json'
+
+
+def merge_types(a, b):
+    """ Widest type able to hold values of both types """
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {'int', 'float'}:
+        return 'float'
+    return 'str'
+
+
+def merge_schemas(schemas):
+    merged = {}
+    for schema in schemas:
+        for name, kind in schema.items():
+            merged[name] = merge_types(merged.get(name), kind)
+    return merged
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def shard_schema(path, start, end):
+    """
+    Property types of a range of features. Runs in a worker process.
+
+    @return: {property name: type}
+    """
+    schema = {}
+    for feature in loads_features(read_range(path, start, end)):
+        for name, value in (feature.get('properties') or {}).items():
+            schema[name] = merge_types(schema.get(name), value_type(value))
+    return schema
+
+
+def field_defn(name, kind):
+    defn = ogr.FieldDefn(name, {'int': ogr.OFTInteger64, 'float': ogr.OFTReal, 'bool': ogr.OFTInteger}.get(kind, ogr.OFTString))
+    if kind == 'bool':
+        defn.SetSubType(ogr.OFSTBoolean)
+    elif kind == 'json':
+        defn.SetSubType(ogr.OFSTJSON)
+    return defn
+
+
+def in_family(geom, family):
+    """
+    The parts of geom belonging to a layer family, as a multi geometry.
+    MakeValid can turn a polygon into a collection of polygons and lines.
+
+    @return: ogr.Geometry or None
+    """
+    kind = ogr.GT_Flatten(geom.GetGeometryType())
+    if kind == ogr.wkbGeometryCollection:
+        multi = ogr.Geometry(LAYER_TYPES[family])
+        for i in range(geom.GetGeometryCount()):
+            part = in_family(geom.GetGeometryRef(i), family)
+            for j in range(part.GetGeometryCount() if part else 0):
+                multi.AddGeometry(part.GetGeometryRef(j))
+        return multi if multi.GetGeometryCount() else None
+    if FAMILIES.get(kind) != family:
+        return None
+    return FORCE_MULTI[family](geom.Clone())
+
+
+def to_ogr(feature):
+    """
+    Geometry of a geojson feature, repaired if invalid
+
+    @return: (ogr.Geometry or None, repaired)
+    """
+    geometry = feature.get('geometry')
+    geom = ogr.CreateGeometryFromJson(dumps(geometry)) if geometry else None
+    family = FAMILIES.get(ogr.GT_Flatten(geom.GetGeometryType())) if geom else None
+    if family is None:
+        return None, False
+    if geom.IsValid():
+        return FORCE_MULTI[family](geom), False
+    repaired = geom.MakeValid() if hasattr(geom, 'MakeValid') else geom.Buffer(0)
+    geom = in_family(repaired, family) if repaired else None
+    if geom is None or geom.IsEmpty():
+        return None, False
+    return geom, True
+
+
+def set_fields(out, feature, schema):
+    """
+    Copies geojson properties to an ogr.Feature, converting values to the schema's types
+
+    @return: properties not in the schema
+    """
+    extra = {}
+    out.SetField(ID_FIELD, str(feature.get('id', '')))
+    for field, value in (feature.get('properties') or {}).items():
+        kind = schema.get(field)
+        if value is None:
+            continue
+        if kind is None or (kind not in ('str', 'json') and merge_types(kind, value_type(value)) != kind):
+            extra[field] = value
+            continue
+        if kind == 'json' or (kind == 'str' and not isinstance(value, str)):
+            value = value if isinstance(value, str) else dumps(value)
+        elif kind == 'bool':
+            value = int(value)
+        elif kind == 'float':
+            value = float(value)
+        out.SetField(field, value)
+    return extra
+
+
+def write_shard(path, start, end, dest, schema):
+    """
+    Parses a range of features, repairs invalid geometries and writes them to a GeoPackage
+    with a layer per geometry type. Runs in a worker process.
+
+    @param path: project GeoJSON
+    @param start: byte offset of the first feature
+    @param end: byte offset after the last feature
+    @param dest: GeoPackage to create
+    @param schema: {property name: type} shared by all shards
+    @return: {features, repaired, skipped}
+    """
+    stats = {'features': 0, 'repaired': 0, 'skipped': 0}
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ds = ogr.GetDriverByName('GPKG').CreateDataSource(dest)
+    layers = {}
+    for name in LAYER_NAMES:
+        layer = ds.CreateLayer(name, srs, LAYER_TYPES[name], options=['SPATIAL_INDEX=YES'])
+        layer.CreateField(ogr.FieldDefn(ID_FIELD, ogr.OFTString))
+        for field, kind in schema.items():
+            layer.CreateField(field_defn(field, kind))
+        layers[name] = layer
+
+    ds.StartTransaction()
+    for feature in loads_features(read_range(path, start, end)):
+        geom, repaired = to_ogr(feature)
+        if geom is None:
+            stats['skipped'] += 1
+            continue
+        stats['repaired'] += repaired
+
+        layer = layers[FAMILIES[ogr.GT_Flatten(geom.GetGeometryType())]]
+        out = ogr.Feature(layer.GetLayerDefn())
+        out.SetGeometry(geom)
+        set_fields(out, feature, schema)
+        layer.CreateFeature(out)
+        stats['features'] += 1
+    ds.CommitTransaction()
+    ds = None
+    return stats
+
+
+def write_vrt(vrt_path, shard_paths, dest=None):
+    """
+    OGR VRT presenting each layer of the shards as one layer
+
+    @param vrt_path: where the vrt will be read from, shard paths are relative to it
+    @param shard_paths: GeoPackage shards
+    @param dest: file to write, defaults to vrt_path
+    """
+    base = os.path.dirname(vrt_path)
+    lines = ['<OGRVRTDataSource>']
+    for name in LAYER_NAMES:
+        lines.append(f'  <OGRVRTUnionLayer name="{name}">')
+        for i, shard in enumerate(shard_paths):
+            lines += [
+                f'    <OGRVRTLayer name="{name}_{i}">',
+                f'      <SrcDataSource relativeToVRT="1">{escape(os.path.relpath(shard, base))}</SrcDataSource>',
+                f'      <SrcLayer>{name}</SrcLayer>',
+                '    </OGRVRTLayer>',
+            ]
+        lines += ['    <FieldStrategy>Union</FieldStrategy>', '  </OGRVRTUnionLayer>']
+    lines.append('</OGRVRTDataSource>')
+    with open(dest or vrt_path, 'w') as f:
+        f.write("\n".join(lines))
+
+
+def convert(path, pool, shards=None, cancel=None):
+    """
+    Converts a project GeoJSON to GeoPackage shards next to it, unioned by <name>.vrt.
+    The previous shards may still be open as layers, so the new ones are staged beside them
+    and only put in place by install_shards, once those layers are removed.
+
+    @param path: project GeoJSON
+    @param pool: concurrent.futures executor (a process pool) to parse and write in
+    @param shards: number of shards, defaults to one per core for large projects
+    @param cancel: CancelToken, checked as shards complete. Shards already running are waited for,
+        then the staged shards are removed
+    @return: (vrt path, {features, repaired, skipped})
+    """
+    with open(path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+        spans = list(FeatureSplitter.spans(mm))
+    shards = shards or max(1, min(os.cpu_count() or 1, len(spans) // MIN_SHARD_FEATURES))
+    ranges = [r[:2] for r in shard_spans(spans, shards)] or [(0, 0)]
+
+    schema = merge_schemas(pool.map(shard_schema, *zip(*[(path, start, end) for start, end in ranges])))
+    if cancel:
+        cancel.check()
+
+    root = os.path.splitext(path)[0]
+    shard_folder = root + SHARD_SUFFIX
+    staged = shard_folder + STAGED_SUFFIX
+    shutil.rmtree(staged, ignore_errors=True)
+    os.makedirs(staged)
+    shard_names = [f"shard_{i:03d}.gpkg" for i in range(len(ranges))]
+    futures = [
+        pool.submit(write_shard, path, start, end, os.path.join(staged, name), schema)
+        for (start, end), name in zip(ranges, shard_names)
+    ]
+    stats = {'features': 0, 'repaired': 0, 'skipped': 0}
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=CANCEL_POLL, return_when=FIRST_COMPLETED)
+            if cancel:
+                cancel.check()
+            for future in done:
+                for key, value in future.result().items():
+                    stats[key] += value
+    except BaseException:
+        pool.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(staged, ignore_errors=True)
+        raise
+
+    vrt_path = root + ".vrt"
+    write_vrt(vrt_path, [os.path.join(shard_folder, name) for name in shard_names], os.path.join(staged, STAGED_VRT))
+    return vrt_path, stats
+
+
+def install_shards(vrt_path):
+    """
+    Puts the shards convert staged in place of the previous ones. Call once layers of the previous
+    shards are removed: open files can't be replaced on Windows, and elsewhere would be unlinked under them
+
+    @param vrt_path: vrt path convert returned
+    @return: vrt_path
+    """
+    shard_folder = os.path.splitext(vrt_path)[0] + SHARD_SUFFIX
+    staged = shard_folder + STAGED_SUFFIX
+    if os.path.isdir(staged):
+        shutil.rmtree(shard_folder, ignore_errors=True)
+        os.replace(os.path.join(staged, STAGED_VRT), vrt_path)
+        os.replace(staged, shard_folder)
+    return vrt_path
+
+
+def driver_available(fmt):
+    """ Whether GDAL was built with the driver for a STREAM_FORMATS format """
+    return ogr.GetDriverByName(STREAM_FORMATS[fmt][0]) is not None
+
+
+class StreamWriter:
+    """
+    Writes geojson features to one FlatGeobuf or GeoParquet layer as they arrive.
+    The schema is inferred from the first SCHEMA_SAMPLE features, properties seen only later
+    (or that do not fit their field's type) are kept as json in EXTRA_FIELD.
+    Features are written to a part file that only replaces dest once closed, so a previous
+    dest stays whole (and loadable) until then, and is kept if writing fails.
+    """
+
+    def __init__(self, dest, fmt, sample=SCHEMA_SAMPLE):
+        """
+        @param dest: file to write
+        @param fmt: key of STREAM_FORMATS
+        @param sample: features to buffer to infer the schema from
+        """
+        self.dest = dest
+        # the extension is kept last, the FlatGeobuf driver writes a folder of layers for other names
+        root, ext = os.path.splitext(dest)
+        self.part = root + ".part" + ext
+        self.driver, _, self.options = STREAM_FORMATS[fmt]
+        self.sample = sample
+        self.pending = []
+        self.ds = None
+        self.layer = None
+        self.schema = None
+        self.stats = {'features': 0, 'repaired': 0, 'skipped': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.ds = None
+            if os.path.exists(self.part):
+                os.remove(self.part)
+
+    def add(self, feature):
+        """ @param feature: geojson feature dict """
+        if self.layer is None:
+            self.pending.append(feature)
+            if len(self.pending) >= self.sample:
+                self.create()
+            return
+        self.write(feature)
+
+    def create(self):
+        self.schema = {}
+        for feature in self.pending:
+            for name, value in (feature.get('properties') or {}).items():
+                self.schema[name] = merge_types(self.schema.get(name), value_type(value))
+        driver = ogr.GetDriverByName(self.driver)
+        if driver is None:
+            raise RuntimeError(f"GDAL has no {self.driver} driver")
+        if os.path.exists(self.part):
+            driver.DeleteDataSource(self.part)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.ds = driver.CreateDataSource(self.part)
+        name = os.path.splitext(os.path.basename(self.dest))[0]
+        self.layer = self.ds.CreateLayer(name, srs, ogr.wkbUnknown, options=self.options)
+        self.layer.CreateField(ogr.FieldDefn(ID_FIELD, ogr.OFTString))
+        for field, kind in self.schema.items():
+            self.layer.CreateField(field_defn(field, kind))
+        self.layer.CreateField(field_defn(EXTRA_FIELD, 'json'))
+        pending, self.pending = self.pending, []
+        for feature in pending:
+            self.write(feature)
+
+    def write(self, feature):
+        geom, repaired = to_ogr(feature)
+        if geom is None:
+            self.stats['skipped'] += 1
+            return
+        self.stats['repaired'] += repaired
+        out = ogr.Feature(self.layer.GetLayerDefn())
+        out.SetGeometry(geom)
+        extra = set_fields(out, feature, self.schema)
+        if extra:
+            out.SetField(EXTRA_FIELD, dumps(extra))
+        self.layer.CreateFeature(out)
+        self.stats['features'] += 1
+
+    def close(self):
+        """
+        Flushes buffered features, builds the spatial index and moves the part file to dest
+
+        @return: {features, repaired, skipped}
+        """
+        if self.schema is not None and self.ds is None:
+            # already closed
+            return self.stats
+        if self.layer is None:
+            self.create()
+        self.layer = None
+        self.ds = None
+        os.replace(self.part, self.dest)
+        return self.stats
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Local storage of feature attachments. Kept free of qgis imports so it can
+ be used from worker processes.
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, UnidentifiedImageError
+except ImportError:
+    Image = None
+    UnidentifiedImageError = OSError
+
+STORE_FOLDER = ".gather_store"
+THUMBNAIL_FOLDER = ".thumbnails"
+THUMBNAIL_SIZE = 256
+THUMBNAIL_CACHE_BYTES = 256 * 1024 * 1024
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def python_executable():
+    """
+    Interpreter to start worker processes with. Inside QGIS sys.executable is the QGIS binary,
+    its bundled interpreter is found under sys.exec_prefix.
+
+    @return: path, or None when sys.executable will do
+    """
+    if sys.platform == "win32":
+        candidates = [os.path.join(sys.exec_prefix, "pythonw.exe")]
+    elif os.path.basename(sys.executable).lower().startswith("python"):
+        return None
+    else:
+        version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        candidates = [os.path.join(sys.exec_prefix, "bin", name) for name in ("python" + version, "python3")]
+    return next((path for path in candidates if os.path.exists(path)), None)
+
+
+def process_pool(max_workers=None):
+    """
+    Process pool which also works inside QGIS, where sys.executable is the QGIS binary
+
+    @param max_workers: number of processes, defaults to cpu count
+    @return: ProcessPoolExecutor
+    """
+    ctx = multiprocessing.get_context("spawn")
+    python = python_executable()
+    if python:
+        ctx.set_executable(python)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx)
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def make_thumbnail(data, dest, size=THUMBNAIL_SIZE):
+    """
+    Downscales an image so its longest side is at most size px. Runs in a worker process.
+    Without Pillow, or when Pillow can't read or write the image, the original is stored as is.
+
+    @param data: raw image bytes
+    @param dest: path to write the thumbnail to
+    @param size: longest side in px
+    @return: dest
+    """
+    tmp_path = dest + ".part"
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                fmt = img.format
+                img.thumbnail((size, size))
+                if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                img.save(tmp_path, format=fmt)
+            os.replace(tmp_path, dest)
+            return dest
+        except (OSError, UnidentifiedImageError, ValueError, Image.DecompressionBombError):
+            pass
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, dest)
+    return dest
+
+
+class ThumbnailCache:
+    """
+    Per-project folder of downscaled attachment previews.
+    Thumbnails are generated in a process pool, the cache is trimmed to max_bytes (least recently used first)
+    """
+
+    def __init__(self, project_folder, size=THUMBNAIL_SIZE, max_bytes=THUMBNAIL_CACHE_BYTES, pool=None):
+        self.folder = os.path.join(project_folder, THUMBNAIL_FOLDER)
+        self.size = size
+        self.max_bytes = max_bytes
+        self.pool = pool
+        self.pending = []
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def __contains__(self, name):
+        return os.path.exists(self.path(name))
+
+    def add(self, name, data):
+        """
+        Queues thumbnail generation for an attachment
+
+        @param name: attachment file name
+        @param data: raw file bytes
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = process_pool()
+            self.pending.append(self.pool.submit(make_thumbnail, data, self.path(name), self.size))
+
+    def touch(self, name):
+        """ Marks a thumbnail as recently used """
+        if name in self:
+            os.utime(self.path(name))
+
+    def close(self):
+        """
+        Waits for queued thumbnails then evicts
+
+        @return: number of thumbnails generated
+        """
+        done = 0
+        for future in self.pending:
+            future.result()
+            done += 1
+        self.pending = []
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.evict()
+        return done
+
+    def evict(self):
+        """
+        Removes the least recently used thumbnails until the cache fits max_bytes
+
+        @return: number of thumbnails removed
+        """
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.endswith(".part"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+
+class BlobStore:
+    """
+    Content addressed store (sha256 -> blob) shared by every project in a local folder.
+    The index maps attachment names to blobs, project files are hardlinks (or copies) of the blobs,
+    so an attachment is transferred and stored once however many features or projects use it.
+    A blob is kept whilst any path referencing it exists, see reference.
+    Safe to put and link from several threads.
+    """
+
+    def __init__(self, folder):
+        self.root = folder
+        self.folder = os.path.join(folder, STORE_FOLDER)
+        self.blobs = os.path.join(self.folder, "blobs")
+        self.index_path = os.path.join(self.folder, "index.json")
+        os.makedirs(self.blobs, exist_ok=True)
+        self.names = {}
+        self.links = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.names = index["names"]
+            self.links = index["links"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
+
+    def __contains__(self, name):
+        return name in self.names and os.path.exists(self.blob_path(self.names[name]))
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def put(self, name, data):
+        """
+        Stores file bytes under their hash
+
+        @param name: attachment file name
+        @param data: file bytes
+        @return: sha256 hex digest
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part = f"{path}.{threading.get_ident()}.part"
+            with open(part, "wb") as f:
+                f.write(data)
+            os.replace(part, path)
+        with self.lock:
+            self.names[name] = digest
+        return digest
+
+    def read(self, name):
+        """ @return: bytes of a stored file """
+        with open(self.blob_path(self.names[name]), "rb") as f:
+            return f.read()
+
+    def link(self, name, dest):
+        """
+        Places a stored file at dest, hardlinked to its blob where the file system allows
+
+        @param name: attachment file name
+        @param dest: path in the project folder
+        @return: dest
+        """
+        digest = self.names[name]
+        blob = self.blob_path(digest)
+        if os.path.exists(dest):
+            if os.path.samefile(dest, blob):
+                return dest
+            os.remove(dest)
+        try:
+            os.link(blob, dest)
+        except OSError:
+            shutil.copyfile(blob, dest)
+        self.reference(name, dest)
+        return dest
+
+    def reference(self, name, path):
+        """
+        Keeps a stored file from garbage collection for as long as path exists, e.g. the thumbnail
+        of a previewed image, whose original stays in the store until it is opened
+
+        @param name: attachment file name
+        @param path: path under the store's folder
+        """
+        digest = self.names[name]
+        rel = os.path.relpath(path, self.root)
+        with self.lock:
+            if rel not in self.links.setdefault(digest, []):
+                self.links[digest].append(rel)
+
+    def save(self):
+        """ Writes the index """
+        with self.lock, open(self.index_path + ".part", "w") as f:
+            json.dump({"names": self.names, "links": self.links}, f)
+        os.replace(self.index_path + ".part", self.index_path)
+
+    def collect_garbage(self):
+        """
+        Removes blobs no longer placed in any project folder nor referenced by a thumbnail
+
+        @return: (blobs removed, bytes freed)
+        """
+        live = {}
+        for digest, paths in self.links.items():
+            paths = [p for p in paths if os.path.exists(os.path.join(self.root, p))]
+            if paths:
+                live[digest] = paths
+        removed = freed = 0
+        for prefix in os.scandir(self.blobs):
+            for entry in os.scandir(prefix.path):
+                if entry.name not in live:
+                    freed += entry.stat().st_size
+                    os.remove(entry.path)
+                    removed += 1
+        self.links = live
+        self.names = {name: digest for name, digest in self.names.items() if digest in live}
+        self.save()
+        return removed, freed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gather Connector local file store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gc = commands.add_parser("gc", help="remove stored files no project uses")
+    gc.add_argument("folder", help="local project folder")
+    args = parser.parse_args(argv)
+
+    removed, freed = BlobStore(args.folder).collect_garbage()
+    print(f"removed {removed} files, freed {freed} bytes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Infers the form Gather builds from an uploaded layer, column by column from
+ the declared field types and a sample of values. Uses numpy when installed.
+ Kept free of qgis imports so it can be tested on its own.
+"""
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SAMPLE_SIZE = 1000
+# text columns with at most this many distinct values, each used more than once on average, become choices.
+# Only when every row was seen, choices from a sample would close the field to values outside it
+CHOICE_MAX = 20
+
+# declared field type (QVariant or OGR type name, lower case) -> form field type
+DECLARED_TYPES = {
+    'int': 'integer', 'integer': 'integer', 'qlonglong': 'integer', 'integer64': 'integer',
+    'uint': 'integer', 'qulonglong': 'integer', 'int4': 'integer', 'int8': 'integer',
+    'double': 'decimal', 'real': 'decimal', 'float': 'decimal', 'float8': 'decimal', 'numeric': 'decimal',
+    'bool': 'boolean', 'boolean': 'boolean',
+    'qdate': 'date', 'date': 'date',
+    'qdatetime': 'datetime', 'datetime': 'datetime',
+    'qtime': 'time', 'time': 'time',
+}
+# declared text types, kept as text whatever the values look like: '01234' is a code, not a number
+DECLARED_TEXT = {'qstring', 'string', 'str', 'text', 'varchar', 'char'}
+_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+_DATETIME = re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?')
+_INTEGER = re.compile(r'[+-]?\d+')
+_DECIMAL = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+
+
+def all_match(pattern, values):
+    return all(map(pattern.fullmatch, values))
+
+
+def is_files(values):
+    """ Whether values look like Gather's feature file lists """
+    return all(isinstance(v, list) and all(isinstance(f, dict) and 'name' in f for f in v) for v in values)
+
+
+def value_type(values):
+    """ Form type of a column of undeclared type, from the python types of its values """
+    if not values:
+        return 'text'
+    if all(isinstance(v, bool) for v in values):
+        return 'boolean'
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return 'integer'
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return 'decimal'
+    if is_files(values):
+        return 'files'
+    if all(isinstance(v, str) for v in values):
+        return text_type(values)
+    return 'text'
+
+
+def text_type(values):
+    """ Form type of a text column, from what its values parse as """
+    if not values:
+        return 'text'
+    if all_match(_DATE, values):
+        return 'date'
+    if all_match(_DATETIME, values):
+        return 'datetime'
+    if all_match(_INTEGER, values):
+        return 'integer'
+    if all_match(_DECIMAL, values):
+        return 'decimal'
+    return 'text'
+
+
+def numeric_range(values, integer=False):
+    """
+    @param values: numbers or numeric strings
+    @param integer: whether they are integers, compared exactly rather than as floats
+    @return: (min, max)
+    """
+    if integer:
+        numbers = list(map(int, values))
+        return min(numbers), max(numbers)
+    if np is not None:
+        array = np.asarray(values, dtype=float)
+        return array.min().item(), array.max().item()
+    numbers = [float(v) for v in values]
+    return min(numbers), max(numbers)
+
+
+def infer_field(name, type_name, values, complete=False):
+    """
+    @param name: column name
+    @param type_name: declared type, e.g. QVariant.typeToName(field.type())
+    @param values: sampled values, None for NULL
+    @param complete: whether values holds every row of the layer. A sample can't tell whether a field is
+        always filled in, its range or its choices, so these are only given for complete columns
+    @return: form field {name, type[, required][, min, max][, choices]}
+    """
+    present = [v for v in values if v is not None]
+    declared = (type_name or '').lower()
+    kind = 'text' if declared in DECLARED_TEXT else DECLARED_TYPES.get(declared) or value_type(present)
+    field = {'name': name, 'type': kind}
+    if not complete:
+        return field
+    field['required'] = bool(values) and len(present) == len(values)
+    if kind in ('integer', 'decimal') and present:
+        field['min'], field['max'] = numeric_range(present, kind == 'integer')
+    elif kind == 'text' and present:
+        choices = set(map(str, present))
+        if len(choices) <= CHOICE_MAX and len(choices) * 2 <= len(present):
+            field['type'] = 'choice'
+            field['choices'] = sorted(choices)
+    return field
+
+
+def infer_form(layer_name, fields, rows, complete=False):
+    """
+    Infers the form of a layer, a column at a time
+
+    @param layer_name: form name
+    @param fields: [(name, declared type name)]
+    @param rows: sampled attribute rows, in the order of fields
+    @param complete: whether rows holds every feature of the layer, see infer_field
+    @return: {name, fields: [form fields]}
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    return {
+        'name': layer_name,
+        'fields': [
+            infer_field(name, type_name, list(column), complete)
+            for (name, type_name), column in zip(fields, columns)
+        ]
+    }
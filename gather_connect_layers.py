@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Prepares a QGIS layer for upload: simplified, rounded geojson and the form inferred
+ from its attributes. Works on a QgsVectorLayerFeatureSource so it can run in a task.
+"""
+from itertools import islice
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsFeatureRequest, QgsJsonExporter, QgsWkbTypes, NULL
+
+try:
+    from .gather_connect_forms import SAMPLE_SIZE, infer_form
+except ImportError:
+    from gather_connect_forms import SAMPLE_SIZE, infer_form
+
+# features simplified and encoded at a time when preparing an upload
+UPLOAD_BATCH = 5000
+
+
+def layer_exporter(layer, options):
+    """
+    GeoJSON exporter for a layer's features which doesn't hold the layer, so it can be used in a task
+
+    @param layer: QgsVectorLayer
+    @param options: UploadOptions
+    @return: QgsJsonExporter
+    """
+    exp = QgsJsonExporter()
+    exp.setPrecision(options.precision)
+    exp.setSourceCrs(layer.crs())
+    exp.setTransformGeometries(True)
+    return exp
+
+
+def reduce_geometry(geom, options):
+    """
+    Drops Z/M and simplifies a geometry. Polygons made invalid by simplifying are repaired,
+    or left unsimplified when nothing of them survives.
+
+    @param geom: QgsGeometry, Z/M are dropped in place
+    @param options: UploadOptions
+    @return: QgsGeometry
+    """
+    if options.drop_zm:
+        geom.get().dropZValue()
+        geom.get().dropMValue()
+    if not options.tolerance:
+        return geom
+    simplified = geom.simplify(options.tolerance)
+    if simplified.isNull() or simplified.isEmpty():
+        return geom
+    if simplified.type() == QgsWkbTypes.PolygonGeometry and not simplified.isGeosValid():
+        simplified = simplified.makeValid()
+        # makeValid may add the lines and points a collapsed ring left behind
+        simplified.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
+        if simplified.isNull() or simplified.isEmpty() or simplified.type() != QgsWkbTypes.PolygonGeometry:
+            return geom
+    return simplified
+
+
+def export_layer(source, exporter, layer_name, options, total=None, cancel=None, progress=None):
+    """
+    Encodes a layer as geojson for upload, simplifying, rounding and dropping Z/M
+    a batch of features at a time. Safe to run in a task.
+
+    @param source: QgsVectorLayerFeatureSource of the layer
+    @param exporter: QgsJsonExporter from layer_exporter
+    @param layer_name: name for the report
+    @param options: UploadOptions
+    @param total: number of features, for progress
+    @param cancel: CancelToken, checked between batches
+    @param progress: callback(stage, done, total)
+    @return: (geojson FeatureCollection str, size reduction report)
+    """
+    features = source.getFeatures(QgsFeatureRequest())
+    before = after = count = 0
+    parts = []
+    while True:
+        if cancel:
+            cancel.check()
+        batch = list(islice(features, UPLOAD_BATCH))
+        if not batch:
+            break
+        for feature in batch:
+            geom = feature.geometry()
+            if geom.isNull():
+                continue
+            before += geom.constGet().nCoordinates()
+            geom = reduce_geometry(geom, options)
+            after += geom.constGet().nCoordinates()
+            feature.setGeometry(geom)
+        parts.append(",".join(exporter.exportFeature(feature) for feature in batch))
+        count += len(batch)
+        if progress:
+            progress('features', count, total)
+    fc = '{"type": "FeatureCollection", "features": [' + ",".join(parts) + ']}'
+    kept = f" ({after / before:.0%})" if before else ""
+    report = (
+        f"{layer_name}: {count} features, {after} of {before} vertices kept{kept}, "
+        f"{options.describe()}, {len(fc.encode()) / 2 ** 20:.1f} MB"
+    )
+    return fc, report
+
+
+def layer_fields(layer):
+    """ @return: [(name, declared type name)] of a layer's fields, as infer_form takes them """
+    return [(field.name(), QVariant.typeToName(field.type())) for field in layer.fields()]
+
+
+def infer_layer_form(source, layer_name, fields):
+    """
+    Form schema of a layer, from its fields and a sample of its attributes. Safe to run in a task.
+
+    @param source: QgsVectorLayerFeatureSource of the layer
+    @param layer_name: form name
+    @param fields: from layer_fields
+    @return: form schema, see infer_form
+    """
+    request = QgsFeatureRequest().setLimit(SAMPLE_SIZE).setFlags(QgsFeatureRequest.NoGeometry)
+    rows = [[None if value == NULL else value for value in f.attributes()] for f in source.getFeatures(request)]
+    return infer_form(layer_name, fields, rows, complete=len(rows) < SAMPLE_SIZE)
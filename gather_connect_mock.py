@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Local mock of the Gather API (listprojects, project, feature and file endpoints)
+ serving synthetic projects, for offline tests and benchmarks.
+
+ Run standalone with:
+    python gather_connect_mock.py --features 10000 --port 8000
+"""
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+
+GEOMETRY_MIX = {'Point': 0.6, 'LineString': 0.2, 'Polygon': 0.2}
+
+
+@dataclass
+class ProjectSpec:
+    """
+    Shape of a synthetic project
+
+    @param name: project name
+    @param features: number of features
+    @param geometry_mix: share of each geometry type
+    @param vertices: vertices per line / polygon ring
+    @param files_per_feature: attachments per feature
+    @param file_size: bytes per attachment
+    @param duplicate_files: share of attachments reusing another feature's file
+    @param seed: random seed, the same spec always gives the same project
+    """
+    name: str
+    features: int = 1000
+    geometry_mix: dict = field(default_factory=lambda: dict(GEOMETRY_MIX))
+    vertices: int = 20
+    files_per_feature: int = 1
+    file_size: int = 64 * 1024
+    duplicate_files: float = 0.0
+    seed: int = 0
+
+    @property
+    def id(self):
+        return hashlib.md5(f"{self.seed}:{self.name}".encode()).hexdigest()[:24]
+
+
+def make_geometry(rng, geom_type, vertices):
+    x, y = rng.uniform(-5, 2), rng.uniform(50, 58)
+    if geom_type == 'Point':
+        return {'type': 'Point', 'coordinates': [x, y]}
+    coords = [[x + rng.uniform(-0.01, 0.01), y + rng.uniform(-0.01, 0.01)] for _ in range(vertices)]
+    if geom_type == 'LineString':
+        return {'type': 'LineString', 'coordinates': coords}
+    return {'type': 'Polygon', 'coordinates': [coords + [coords[0]]]}
+
+
+def make_project(spec):
+    """
+    @param spec: ProjectSpec
+    @return: geojson FeatureCollection
+    """
+    rng = random.Random(spec.seed)
+    types = list(spec.geometry_mix)
+    weights = [spec.geometry_mix[t] for t in types]
+    features = []
+    files = []
+    for i in range(spec.features):
+        feature_files = []
+        for j in range(spec.files_per_feature):
+            if files and rng.random() < spec.duplicate_files:
+                feature_files.append(dict(rng.choice(files)))
+            else:
+                feature_files.append({'name': f"{spec.id}-{i}-{j}.jpg", 'size': spec.file_size})
+                files.append(feature_files[-1])
+        properties = {
+            'name': f"feature {i}",
+            'surveyor': rng.choice(['ann', 'bob', 'cat']),
+            'count': rng.randint(0, 100),
+            'score': rng.random(),
+            'checked': rng.random() < 0.5,
+            'created': f"2023-01-{rng.randint(1, 28):02d}T12:00:00Z",
+        }
+        if feature_files:
+            properties['files'] = feature_files
+        features.append({
+            'type': 'Feature',
+            'id': i,
+            'geometry': make_geometry(rng, rng.choices(types, weights)[0], spec.vertices),
+            'properties': properties
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def make_file(name, size):
+    """ Deterministic attachment bytes, base64 encoded as the file endpoint returns them """
+    rng = random.Random(name)
+    return base64.b64encode(rng.randbytes(size))
+
+
+class MockGatherServer(ThreadingHTTPServer):
+    """
+    Serves synthetic projects on 127.0.0.1, use with GatherCloud(host=server.host, secure=False)
+
+    @param projects: [ProjectSpec]
+    @param latency: seconds added before every response
+    @param bandwidth: bytes per second to send responses at, None for unlimited
+    @param failure_rate: share of requests answered with 503
+    @param truncate: number of project downloads cut off halfway through the body
+    """
+    daemon_threads = True
+
+    def __init__(self, projects, latency=0.0, bandwidth=None, failure_rate=0.0, truncate=0, port=0):
+        super().__init__(("127.0.0.1", port), MockGatherHandler)
+        self.projects = {spec.id: spec for spec in projects}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.truncate = truncate
+        self.rng = random.Random(0)
+        self.cache = {}
+        self.uploads = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def project_bytes(self, project_id):
+        with self.lock:
+            if project_id not in self.cache:
+                self.cache[project_id] = json.dumps(make_project(self.projects[project_id])).encode()
+            return self.cache[project_id]
+
+    def file_size(self, name):
+        for spec in self.projects.values():
+            if name.startswith(spec.id):
+                return spec.file_size
+        return None
+
+
+class MockGatherHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not self.server.bandwidth:
+            self.wfile.write(body)
+            return
+        chunk = max(1, int(self.server.bandwidth / 20))
+        try:
+            for i in range(0, len(body), chunk):
+                self.wfile.write(body[i:i + chunk])
+                time.sleep(chunk / self.server.bandwidth)
+        except ConnectionError:
+            pass  # client cancelled
+
+    def cut_off(self, body):
+        """ Sends half of body and drops the connection, as a reset mid download would """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2])
+        self.close_connection = True
+
+    def error(self, status, message):
+        self.reply(status, json.dumps({'error': message}).encode())
+
+    def route(self):
+        with self.server.lock:
+            self.server.requests += 1
+            failed = self.server.rng.random() < self.server.failure_rate
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if failed:
+            return self.error(503, "injected failure")
+        if not self.headers.get('email') or not self.headers.get('password'):
+            return self.error(401, "missing credentials")
+        url = urlparse(self.path)
+        return url.path.rsplit("/", 1)[-1], {k: v[0] for k, v in parse_qs(url.query).items()}
+
+    def do_GET(self):
+        route = self.route()
+        if route is None:
+            return
+        endpoint, query = route
+        if endpoint == "listprojects":
+            projects = [{'id': spec.id, 'name': spec.name} for spec in self.server.projects.values()]
+            return self.reply(200, json.dumps(projects).encode())
+        if endpoint == "project" and query.get('id') in self.server.projects:
+            body = self.server.project_bytes(query['id'])
+            with self.server.lock:
+                truncated = self.server.truncate > 0
+                self.server.truncate -= truncated
+            if truncated:
+                return self.cut_off(body)
+            return self.reply(200, body)
+        if endpoint == "file":
+            size = self.server.file_size(query.get('name', ''))
+            if size is not None:
+                return self.reply(200, make_file(query['name'], size), "text/plain")
+        self.error(404, "not found")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        route = self.route()
+        if route is None:
+            return
+        endpoint, query = route
+        if endpoint != "feature" or query.get('id') not in self.server.projects:
+            return self.error(404, "not found")
+        try:
+            upload = json.loads(body)
+            features = upload['geojson']['features']
+        except (ValueError, KeyError, TypeError) as ex:
+            return self.reply(200, json.dumps({'success': False, 'error': str(ex)}).encode())
+        with self.server.lock:
+            self.server.uploads.append(upload)
+        self.reply(200, json.dumps({'success': True, 'featureCount': len(features), 'formCount': 1}).encode())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Gather API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--projects", type=int, default=1)
+    parser.add_argument("--features", type=int, default=1000)
+    parser.add_argument("--files-per-feature", type=int, default=1)
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    specs = [
+        ProjectSpec(f"project {i}", args.features, files_per_feature=args.files_per_feature,
+                    file_size=args.file_size, seed=i)
+        for i in range(args.projects)
+    ]
+    server = MockGatherServer(specs, latency=args.latency, port=args.port)
+    print(f"serving {args.projects} projects on {server.host}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,670 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ HTTP requests with timeouts, retries, rate limiting and a circuit breaker per host,
+ plus timing of every network and disk operation, cancellation and progress reporting.
+ Kept free of qgis imports so it can be tested on its own.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, fields
+from email.utils import parsedate_to_datetime
+import csv
+import http.client
+import json
+import os
+import random
+import socket
+import ssl
+import threading
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CHUNK_SIZE = 1 << 20
+
+
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'decode', 'encode', 'write', 'convert', 'load')
+# jobs JobMetrics.save keeps in a metrics folder
+METRICS_KEEP = 50
+
+
+@dataclass
+class OpMetric:
+    """
+    Timings (seconds) and sizes of one operation. Requests fill the network phases,
+    decode/encode/write/convert/load are timed by the code handling the data
+    """
+    operation: str
+    url: str = ''
+    status: int = None
+    attempts: int = 0
+    dns: float = 0.0
+    connect: float = 0.0
+    tls: float = 0.0
+    ttfb: float = 0.0
+    transfer: float = 0.0
+    decode: float = 0.0
+    encode: float = 0.0
+    write: float = 0.0
+    convert: float = 0.0
+    load: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    error: str = ''
+
+    @contextmanager
+    def timing(self, phase):
+        """ Adds the time spent in the block to a phase, for phases interleaved with others """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            setattr(self, phase, getattr(self, phase) + time.perf_counter() - start)
+
+
+class JobMetrics:
+    """ Collects OpMetrics of a job (e.g. loading a project) for a summary and export """
+
+    def __init__(self, job):
+        self.job = job
+        self.started = time.time()
+        self.finished = None
+        self.ops = []
+        self.lock = threading.Lock()
+
+    def record(self, metric):
+        with self.lock:
+            self.ops.append(metric)
+
+    @contextmanager
+    def timed(self, operation, phase, nbytes=0):
+        """
+        Times a local phase (decode, encode, write, convert, load) of an operation
+
+        @param operation: name of the operation
+        @param phase: one of decode, encode, write, convert, load
+        @param nbytes: bytes handled
+        """
+        metric = OpMetric(operation, bytes_received=nbytes)
+        start = time.perf_counter()
+        try:
+            yield metric
+        finally:
+            setattr(metric, phase, time.perf_counter() - start)
+            self.record(metric)
+
+    def finish(self):
+        self.finished = time.time()
+        return self
+
+    def totals(self):
+        """
+        @return: {operation: {count, errors, bytes_sent, bytes_received, <phase>: seconds}}
+        """
+        totals = {}
+        with self.lock:
+            ops = list(self.ops)
+        for op in ops:
+            total = totals.setdefault(op.operation, dict(
+                count=0, errors=0, bytes_sent=0, bytes_received=0, **{p: 0.0 for p in PHASES}
+            ))
+            total['count'] += 1 if op.attempts else 0
+            total['errors'] += 1 if op.error else 0
+            # local phases record the size they handled, count bytes once, as they crossed the network
+            if op.attempts:
+                total['bytes_sent'] += op.bytes_sent
+                total['bytes_received'] += op.bytes_received
+            for phase in PHASES:
+                total[phase] += getattr(op, phase)
+        return totals
+
+    def summary(self):
+        """ Plain text table of time spent per operation and phase """
+        wall = (self.finished or time.time()) - self.started
+        lines = [f"{self.job}: {wall:.2f}s"]
+        for operation, total in self.totals().items():
+            phases = ", ".join(f"{p} {total[p]:.3f}s" for p in PHASES if total[p])
+            received = total['bytes_received']
+            network = total['ttfb'] + total['transfer']
+            rate = f", {received / network / 1024:.0f} KB/s" if network and received else ""
+            lines.append(
+                f"  {operation}: {total['count']} requests, {total['errors']} errors, "
+                f"{received / 1024:.0f} KB in{rate} | {phases}"
+            )
+        return "\n".join(lines)
+
+    def export(self, path):
+        """
+        Writes every OpMetric to path, as csv if path ends .csv otherwise json
+
+        @param path: file to write
+        @return: path
+        """
+        with self.lock:
+            rows = [asdict(op) for op in self.ops]
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, fieldnames=[fld.name for fld in fields(OpMetric)])
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump({
+                    "job": self.job,
+                    "started": self.started,
+                    "finished": self.finished,
+                    "totals": self.totals(),
+                    "operations": rows
+                }, f, indent=1)
+        return path
+
+    def save(self, folder, keep=METRICS_KEEP):
+        """
+        Exports the job as json and csv to folder, named by its start time, removing all but the latest keep jobs
+
+        @param folder: metrics folder, created if missing
+        @param keep: jobs to keep
+        @return: path of the json export
+        """
+        os.makedirs(folder, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        name += "-" + "".join(c if c.isalnum() else "_" for c in self.job)
+        path = self.export(os.path.join(folder, name + ".json"))
+        self.export(os.path.join(folder, name + ".csv"))
+        jobs = {os.path.splitext(entry)[0] for entry in os.listdir(folder) if entry.endswith((".json", ".csv"))}
+        for job in sorted(jobs)[:-keep]:
+            for ext in (".json", ".csv"):
+                if os.path.exists(os.path.join(folder, job + ext)):
+                    os.remove(os.path.join(folder, job + ext))
+        return path
+
+
+class FetchError(Exception):
+    """ A request failed with an error status """
+
+    def __init__(self, status, reason, body=b''):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        super().__init__(f"{status} {reason}: {body[:200].decode(errors='replace')}".rstrip(": "))
+
+
+class CircuitOpenError(Exception):
+    """ The host has failed repeatedly, requests are refused until it cools down """
+
+
+class CancelledError(Exception):
+    """ The job was cancelled """
+
+
+class CancelToken:
+    """
+    Cancels a job from another thread. Connections in use are shut down,
+    so blocked reads return at once rather than at their timeout.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.conns = set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+        with self.lock:
+            conns, self.conns = self.conns, set()
+        for conn in conns:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+
+    def check(self):
+        """ @raise CancelledError: if cancelled """
+        if self.cancelled:
+            raise CancelledError("cancelled")
+
+    def wait(self, seconds):
+        """
+        Sleeps, waking early when cancelled
+
+        @raise CancelledError: if cancelled
+        """
+        self.event.wait(seconds)
+        self.check()
+
+    def track(self, conn):
+        """ Shuts conn down on cancel, until untracked """
+        with self.lock:
+            self.conns.add(conn)
+        if self.cancelled:
+            self.cancel()
+
+    def untrack(self, conn):
+        with self.lock:
+            self.conns.discard(conn)
+
+
+class Progress:
+    """
+    Turns progress updates of a job's stages into a percentage, throughput and ETA.
+    Stages may run at once (a project streaming whilst its files download), each is timed on its own
+    and the status covers all of them.
+    """
+
+    # stages counted in bytes, the rest count items
+    BYTE_STAGES = ('project', 'upload')
+    # seconds a stage must have run before its rate is shown
+    MIN_ELAPSED = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stage -> [start time, done at start, done, total]
+        self.stages = {}
+
+    def update(self, stage, done, total=None):
+        """
+        @param stage: what is progressing, e.g. project, files, upload
+        @param done: bytes or items done so far in this stage
+        @param total: bytes or items expected, None if not known yet
+        @return: (percent or None, status text)
+        """
+        now = time.monotonic()
+        with self.lock:
+            state = self.stages.setdefault(stage, [now, done, done, total])
+            state[2], state[3] = done, total
+            stages = [(name, *state) for name, state in self.stages.items()]
+        percents = [100.0 * min(done, total) / total for _, _, _, done, total in stages if total]
+        # finished stages drop out of the text, but still count towards the percentage
+        texts = [
+            self.describe(*entry, now) for entry in stages
+            if entry[0] == stage or not entry[4] or entry[3] < entry[4]
+        ]
+        return (sum(percents) / len(percents) if percents else None), "; ".join(texts)
+
+    def describe(self, stage, start, first, done, total, now):
+        """ @return: status text of one stage """
+        scale, unit = (2 ** 20, " MB") if stage in self.BYTE_STAGES else (1, "")
+        digits = 1 if scale > 1 else 0
+        text = f"{stage}: {done / scale:.{digits}f}"
+        if total:
+            text += f" of {total / scale:.{digits}f}"
+        text += unit
+        elapsed = now - start
+        if elapsed < self.MIN_ELAPSED:
+            return text
+        rate = (done - first) / elapsed
+        text += f", {rate / scale:.1f}{unit or ' items'}/s"
+        if total and rate and done < total:
+            text += f", {(total - done) / rate:.0f} s left"
+        return text
+
+
+@dataclass
+class RetryPolicy:
+    """
+    How hard to try a request
+
+    @param connect_timeout: seconds to wait for the connection
+    @param read_timeout: seconds to wait for each read from the socket
+    @param retries: attempts after the first one
+    @param backoff: base delay in seconds, doubled on every attempt (with full jitter)
+    @param max_backoff: longest delay in seconds, Retry-After is honoured up to this
+    @param retry_statuses: response statuses worth another attempt
+    @param idempotent: whether a request may be sent again after a failure once it was sent. When False
+        only failures before the request went out (DNS, connect, TLS) are retried, as the server may
+        have acted on a request that timed out or lost its connection.
+    """
+    connect_timeout: float = 10
+    read_timeout: float = 60
+    retries: int = 4
+    backoff: float = 0.5
+    max_backoff: float = 60
+    retry_statuses: tuple = RETRY_STATUSES
+    idempotent: bool = True
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the next attempt
+
+        @param attempt: number of attempts made so far (from 0)
+        @param retry_after: Retry-After header of the failed response
+        @return: seconds
+        """
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    seconds = None
+            if seconds is not None:
+                return min(max(seconds, 0), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a host is down.
+    Opens after failure_threshold consecutive failures, lets a trial request through after reset_timeout
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before(self):
+        """ Raises CircuitOpenError whilst the circuit is open """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"too many failures, retrying in {self.reset_timeout}s")
+            # half open: let this request through, the next failure reopens
+            self.opened_at = None
+            self.failures = self.failure_threshold - 1
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(host):
+    """ The CircuitBreaker shared by all requests to host """
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+
+
+class RateLimiter:
+    """
+    Token bucket with a cap on requests in flight, shared by all requests to a host.
+    The rate halves on every 429 and creeps back up by increase requests/s for each second of successes,
+    so it settles just below what the server sustains.
+    """
+
+    def __init__(self, rate=10.0, max_rate=50.0, min_rate=0.5, increase=1.0, burst=None, max_in_flight=8):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """ Blocks until a request may be sent """
+        self.in_flight.acquire()
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self, status=None):
+        """
+        Frees the in flight slot and adapts the rate
+
+        @param status: response status, None if the request failed
+        """
+        with self.lock:
+            if status == 429:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+            elif status is not None and status < 400:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+        self.in_flight.release()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(host):
+    """ The RateLimiter shared by all requests to host """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter()
+        return _limiters[host]
+
+
+def set_limiter(host, limiter):
+    """ Replaces the RateLimiter of host, e.g. to match an API plan's limits """
+    with _limiters_lock:
+        _limiters[host] = limiter
+
+
+class Fetch:
+    """ Request data return response """
+
+    @staticmethod
+    def connect(host, policy, secure=True, metric=None):
+        """
+        Opens a connection, timing DNS, TCP connect and TLS handshake separately
+
+        @return: connected http.client.HTTPConnection
+        """
+        metric = metric or OpMetric('')
+        conn_class = http.client.HTTPSConnection if secure else http.client.HTTPConnection
+        conn = conn_class(host, timeout=policy.connect_timeout)
+
+        start = time.perf_counter()
+        addresses = socket.getaddrinfo(conn.host, conn.port, type=socket.SOCK_STREAM)
+        metric.dns += time.perf_counter() - start
+
+        start = time.perf_counter()
+        sock = None
+        for family, kind, proto, _, address in addresses:
+            sock = socket.socket(family, kind, proto)
+            sock.settimeout(policy.connect_timeout)
+            try:
+                sock.connect(address)
+                break
+            except OSError:
+                sock.close()
+                if address == addresses[-1][4]:
+                    raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        metric.connect += time.perf_counter() - start
+
+        if secure:
+            start = time.perf_counter()
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=conn.host)
+            metric.tls += time.perf_counter() - start
+
+        sock.settimeout(policy.read_timeout)
+        conn.sock = sock
+        return conn
+
+    @staticmethod
+    def request(host, url, headers, payload='', verb="GET", policy=None, secure=True, metrics=None, operation=None,
+                cancel=None):
+        """
+        Sends a request, retrying connection failures and retry_statuses.
+        Failures after the request was sent are only retried for idempotent policies.
+        The body is left unread, see Fetch.fetch for retries that cover reading the body too.
+
+        @param metrics: JobMetrics to record timings in
+        @param operation: name to record timings under, defaults to url
+        @param cancel: CancelToken aborting the request, and reads of the response by Fetch.chunks
+        @return: http.client.HTTPResponse with a success status
+        @raise FetchError: on an error status once retries are spent
+        @raise CircuitOpenError: when the host keeps failing
+        @raise CancelledError: when cancelled
+        """
+        return Fetch.send(host, url, headers, payload, verb, policy, secure, False, metrics, operation, cancel)
+
+    @staticmethod
+    def fetch(host, url, headers, payload='', verb="GET", policy=None, secure=True, metrics=None, operation=None,
+              cancel=None):
+        """
+        Sends a request and reads the whole body, retrying failures whilst reading too
+
+        @return: response body bytes
+        """
+        return Fetch.send(host, url, headers, payload, verb, policy, secure, True, metrics, operation, cancel)
+
+    @staticmethod
+    def chunks(res, size=CHUNK_SIZE):
+        """
+        Reads the body of a Fetch.request response as it arrives, timing the transfer
+
+        @param res: http.client.HTTPResponse
+        @param size: most bytes per chunk, chunks are yielded as soon as any data arrives
+        @return: generator of bytes
+        """
+        metric = getattr(res, 'metric', None) or OpMetric('')
+        cancel = getattr(res, 'cancel', None)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = res.read1(size)
+                except (OSError, http.client.HTTPException):
+                    if cancel:
+                        cancel.check()
+                    raise
+                metric.transfer += time.perf_counter() - start
+                if cancel:
+                    cancel.check()
+                if not chunk:
+                    if getattr(res, 'length', None):
+                        # the connection closed before Content-Length was reached, read1 doesn't raise for that
+                        raise http.client.IncompleteRead(b'', res.length)
+                    return
+                metric.bytes_received += len(chunk)
+                yield chunk
+        finally:
+            res.close()
+            if getattr(res, 'conn', None) is not None:
+                if cancel:
+                    cancel.untrack(res.conn)
+                res.conn.close()
+
+    @staticmethod
+    def send(host, url, headers, payload, verb, policy, secure, read, metrics=None, operation=None, cancel=None):
+        policy = policy or RetryPolicy()
+        metric = OpMetric(operation or url, url=url, bytes_sent=len(payload or ''))
+        try:
+            return Fetch.attempt(host, url, headers, payload, verb, policy, secure, read, metric, cancel)
+        finally:
+            if metrics is not None:
+                metrics.record(metric)
+
+    @staticmethod
+    def attempt(host, url, headers, payload, verb, policy, secure, read, metric, cancel=None):
+        breaker = breaker_for(host)
+        limiter = limiter_for(host)
+        sleep = cancel.wait if cancel else time.sleep
+        for attempt in range(policy.retries + 1):
+            if cancel:
+                cancel.check()
+            breaker.before()
+            last = attempt == policy.retries
+            status = None
+            conn = None
+            streaming = False
+            sent = False
+            metric.attempts += 1
+            limiter.acquire()
+            try:
+                conn = Fetch.connect(host, policy, secure, metric)
+                if cancel:
+                    cancel.track(conn)
+                start = time.perf_counter()
+                sent = True
+                conn.request(verb, url, payload, headers)
+                res = conn.getresponse()
+                metric.ttfb += time.perf_counter() - start
+                if res.status < 400:
+                    if not read:
+                        status = metric.status = res.status
+                        metric.error = ''
+                        breaker.success()
+                        res.metric = metric
+                        res.conn = conn
+                        res.cancel = cancel
+                        streaming = True
+                        return res
+                    start = time.perf_counter()
+                    data = res.read()
+                    metric.transfer += time.perf_counter() - start
+                    if cancel:
+                        cancel.check()
+                    metric.bytes_received += len(data)
+                    conn.close()
+                    status = metric.status = res.status
+                    metric.error = ''
+                    breaker.success()
+                    return data
+                body = res.read()
+                conn.close()
+                status = metric.status = res.status
+            except (OSError, http.client.HTTPException) as ex:
+                metric.error = f"{type(ex).__name__}: {ex}"
+                if cancel:
+                    cancel.check()
+                breaker.failure()
+                if last or (sent and not policy.idempotent):
+                    raise
+            finally:
+                limiter.release(status)
+                if conn and not streaming:
+                    if cancel:
+                        cancel.untrack(conn)
+                    conn.close()
+
+            if status is None:
+                sleep(policy.delay(attempt))
+                continue
+
+            metric.error = f"{res.status} {res.reason}"
+            if res.status >= 500:
+                breaker.failure()
+            if last or res.status not in policy.retry_statuses:
+                raise FetchError(res.status, res.reason, body)
+            sleep(policy.delay(attempt, res.getheader("Retry-After")))
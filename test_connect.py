@@ -22,18 +22,30 @@
 """
 import json
 import os.path
+import threading
 import unittest
 import tempfile
 
-from gather_connect import Fetch
-from gather_connect import GatherCloud
+from gather_connect_cloud import GatherCloud, UploadOptions
+from gather_connect_files import BlobStore
+from gather_connect_mock import MockGatherServer, ProjectSpec, make_project
+from gather_connect_net import CancelledError, CancelToken, Fetch, RetryPolicy
 
-PROJECT_IDX = os.environ["PROJECT_IDX"]
-PROJECT_ID = os.environ["PROJECT_ID"]
-NUM_FEATS = os.environ["NUM_FEATS"]
-EMAIL = os.environ['EMAIL']
-PASSWORD = os.environ['PASSWORD']
+try:
+    from qgis.core import QgsFeature, QgsGeometry, QgsVectorLayer, QgsVectorLayerFeatureSource, QgsWkbTypes
+    from qgis.testing import start_app
+    from gather_connect_layers import export_layer, layer_exporter, reduce_geometry
+except ImportError:
+    start_app = None
 
+PROJECT_IDX = os.environ.get("PROJECT_IDX")
+PROJECT_ID = os.environ.get("PROJECT_ID")
+NUM_FEATS = os.environ.get("NUM_FEATS")
+EMAIL = os.environ.get('EMAIL')
+PASSWORD = os.environ.get('PASSWORD')
+
+
+@unittest.skipUnless(EMAIL and PASSWORD, "needs live Gather credentials")
 class Testing(unittest.TestCase):
     def test_fetch(self):
         res = Fetch.request(host="swapi.dev", url="/api/planets/1/", headers={})
@@ -70,5 +82,202 @@ class Testing(unittest.TestCase):
             self.assertTrue(files[0].endswith(".jpg"))
 
 
+class TestingOffline(unittest.TestCase):
+    """ The same journey against the local mock server """
+
+    def test_cloud(self):
+        spec = ProjectSpec("offline", features=50, files_per_feature=2, file_size=1024, duplicate_files=0.3)
+        with MockGatherServer([spec]) as server, tempfile.TemporaryDirectory() as folder:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False)
+            projects = cloud.fetch_project_list()
+            with self.subTest():
+                self.assertEqual(projects[0]['id'], spec.id)
+
+            project = cloud.fetch_project(selected_project=spec.name)
+            with self.subTest():
+                self.assertEqual(len(project['features']), spec.features)
+
+            dwnld_path = os.path.join(folder, spec.name + ".geojson")
+            _, result_file = cloud.download_project(selected_project=spec.name, dwnld_path=dwnld_path)
+            with self.subTest():
+                self.assertTrue(os.path.exists(result_file))
+
+            result = cloud.download_project_files(selected_project=spec.name, folder=folder)
+            names = {f['name'] for feat in project['features'] for f in feat['properties']['files']}
+            with self.subTest():
+                self.assertEqual(result.title, "Success")
+            with self.subTest():
+                self.assertEqual(set(os.listdir(os.path.join(folder, spec.name))) - {'.thumbnails'}, names)
+
+            form = {"name": "layer", "fields": [{"name": "count", "type": "integer", "required": True}]}
+            result = cloud.add_fc_to_project(spec.name, "layer", spec.id, project, form=form)
+            with self.subTest():
+                self.assertEqual(result.title, "Success")
+            with self.subTest():
+                self.assertEqual(len(server.uploads), 1)
+            with self.subTest():
+                self.assertEqual(server.uploads[0]["form"], form)
+
+    def test_manifest(self):
+        spec = ProjectSpec("manifest", features=20, files_per_feature=2, file_size=16)
+        with MockGatherServer([spec]) as server:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False)
+            cloud.fetch_project_list()
+            manifest = list(cloud.fetch_manifest(spec.name))
+        features = make_project(spec)['features']
+        self.assertEqual(manifest, [(f['id'], f['properties']['files']) for f in features])
+
+    def test_stale_project(self):
+        spec = ProjectSpec("stale", features=10, files_per_feature=1, file_size=16)
+        with MockGatherServer([spec]) as server, tempfile.TemporaryDirectory() as folder:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False)
+            cloud.fetch_project_list()
+            stale = os.path.join(folder, spec.name + ".geojson")
+            with open(stale, "w") as f:
+                json.dump({"type": "FeatureCollection", "features": []}, f)
+            result = cloud.download_project_files(spec.name, folder)
+            with self.subTest():
+                self.assertEqual(result.text, "10 files downloaded (10 fetched)")
+            result = cloud.download_project_files(spec.name, folder, cached=stale)
+            with self.subTest():
+                self.assertEqual(result.text, "0 files downloaded (0 fetched)")
+
+    def test_sync_project(self):
+        spec = ProjectSpec("sync", features=30, files_per_feature=2, file_size=256, duplicate_files=0.3)
+        with MockGatherServer([spec]) as server, tempfile.TemporaryDirectory() as folder:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False)
+            cloud.fetch_project_list()
+            loaded = []
+            result = cloud.sync_project(spec.name, folder, on_project=loaded.append)
+            names = {f['name'] for feat in make_project(spec)['features'] for f in feat['properties']['files']}
+            with self.subTest():
+                self.assertEqual(result.title, "Success")
+            with self.subTest():
+                self.assertEqual(loaded, [(spec.name, os.path.join(folder, spec.name + ".geojson").replace(os.sep, "/"))])
+            with self.subTest():
+                self.assertEqual(set(os.listdir(os.path.join(folder, spec.name))), names)
+
+    def test_sync_retry(self):
+        spec = ProjectSpec("retry", features=30, files_per_feature=2, file_size=256, duplicate_files=0.3)
+        with MockGatherServer([spec], truncate=1) as server, tempfile.TemporaryDirectory() as folder:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False,
+                                policies={'project': RetryPolicy(backoff=0)})
+            cloud.fetch_project_list()
+            result = cloud.sync_project(spec.name, folder)
+            names = {f['name'] for feat in make_project(spec)['features'] for f in feat['properties']['files']}
+            with self.subTest():
+                self.assertEqual(result.text, f"{len(names)} files downloaded ({len(names)} fetched)")
+            with self.subTest():
+                self.assertEqual(set(os.listdir(os.path.join(folder, spec.name))), names)
+            with open(os.path.join(folder, spec.name + ".geojson"), "rb") as f:
+                self.assertEqual(f.read(), server.project_bytes(spec.id))
+
+    def test_preview(self):
+        spec = ProjectSpec("preview", features=10, files_per_feature=1, file_size=256)
+        with MockGatherServer([spec]) as server, tempfile.TemporaryDirectory() as folder:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False)
+            cloud.fetch_project_list()
+            result = cloud.sync_project(spec.name, folder, preview=True)
+            names = {f['name'] for feat in make_project(spec)['features'] for f in feat['properties']['files']}
+            with self.subTest():
+                self.assertEqual(result.title, "Success")
+            with self.subTest():
+                self.assertEqual(set(os.listdir(os.path.join(folder, spec.name, ".thumbnails"))), names)
+            # originals were kept in the store, cleaning it whilst their thumbnails are there keeps them,
+            # and opening one doesn't download it again
+            with self.subTest():
+                self.assertEqual(BlobStore(folder).collect_garbage()[0], 0)
+            requests = server.requests
+            path = cloud.fetch_original(spec.name, folder, sorted(names)[0])
+            with self.subTest():
+                self.assertTrue(os.path.exists(path))
+            with self.subTest():
+                self.assertEqual(server.requests, requests)
+
+    def test_stream_timing(self):
+        spec = ProjectSpec("timing", features=300, files_per_feature=0)
+        with MockGatherServer([spec], bandwidth=1_000_000) as server, tempfile.TemporaryDirectory() as folder:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False)
+            cloud.fetch_project_list()
+            metrics = cloud.start_job("timing")
+            cloud.download_project(spec.name, os.path.join(folder, "timing.geojson"))
+            network, local = [op for op in metrics.ops if op.operation == 'project']
+            # waiting on the network isn't counted as writing
+            with self.subTest():
+                self.assertLess(local.write, network.transfer / 2)
+            with self.subTest():
+                self.assertGreater(local.write, 0)
+
+    def test_cancel_download(self):
+        spec = ProjectSpec("cancel", features=2000, files_per_feature=0)
+        with MockGatherServer([spec], bandwidth=200_000) as server, tempfile.TemporaryDirectory() as folder:
+            cloud = GatherCloud("test@example.com", "test", host=server.host, secure=False)
+            cloud.fetch_project_list()
+            cancel = CancelToken()
+            progress = []
+            threading.Timer(0.3, cancel.cancel).start()
+            with self.assertRaises(CancelledError):
+                cloud.download_project(spec.name, os.path.join(folder, "cancel.geojson"), cancel=cancel,
+                                       progress=lambda *args: progress.append(args))
+            with self.subTest():
+                self.assertEqual(os.listdir(folder), [])
+            with self.subTest():
+                self.assertEqual(progress[-1][2], len(server.project_bytes(spec.id)))
+
+
+class TestingUpload(unittest.TestCase):
+    """ Preparing a layer for upload """
+
+    NOTCHED = (
+        "POLYGON ((0 0, 4 0, 5 -0.8, 6 0, 10 0, 10 10, 5.2 10, 5.1 -0.4, 4.9 -0.4, 4.8 10, 0 10, 0 0))"
+    )
+
+    @classmethod
+    def setUpClass(cls):
+        if start_app:
+            start_app()
+
+    def test_describe(self):
+        with self.subTest():
+            self.assertEqual(UploadOptions().describe(), "6 decimals")
+        with self.subTest():
+            self.assertEqual(
+                UploadOptions(precision=3, tolerance=0.5, drop_zm=True).describe(),
+                "3 decimals, simplified to 0.5, Z/M dropped"
+            )
+
+    @unittest.skipUnless(start_app, "needs a QGIS install")
+    def test_export_layer(self):
+        layer = QgsVectorLayer("PointZ?crs=epsg:4326&field=n:integer", "points", "memory")
+        features = []
+        for n in range(3):
+            feature = QgsFeature(layer.fields())
+            feature.setGeometry(QgsGeometry.fromWkt(f"PointZ ({n}.123456789 2.987654321 5)"))
+            feature.setAttributes([n])
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        options = UploadOptions(precision=3, drop_zm=True)
+        fc, report = export_layer(
+            QgsVectorLayerFeatureSource(layer), layer_exporter(layer, options), "points", options, layer.featureCount()
+        )
+        exported = json.loads(fc)["features"]
+        with self.subTest():
+            self.assertEqual([f["geometry"]["coordinates"] for f in exported], [[n + 0.123, 2.988] for n in range(3)])
+        with self.subTest():
+            self.assertEqual([f["properties"]["n"] for f in exported], [0, 1, 2])
+        with self.subTest():
+            self.assertTrue(report.startswith("points: 3 features, 3 of 3 vertices kept"))
+
+    @unittest.skipUnless(start_app, "needs a QGIS install")
+    def test_simplified_polygons_valid(self):
+        geom = reduce_geometry(QgsGeometry.fromWkt(self.NOTCHED), UploadOptions(tolerance=1))
+        with self.subTest():
+            self.assertTrue(geom.isGeosValid())
+        with self.subTest():
+            self.assertEqual(geom.type(), QgsWkbTypes.PolygonGeometry)
+        with self.subTest():
+            self.assertLess(geom.constGet().nCoordinates(), 12)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
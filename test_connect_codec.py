@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Unit Tests
+
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import os.path
+import tempfile
+import unittest
+
+import gather_connect_codec as codec
+from gather_connect_codec import FeatureSplitter, ProjectReader, feature_manifest, loads_features, shard_spans
+
+FC = {"type": "FeatureCollection", "features": [
+    {"type": "Feature", "geometry": {"type": "Point", "coordinates": [1.5, 52.25]}, "properties": {"name": "café", "n": 3}}
+]}
+
+
+class Testing(unittest.TestCase):
+    def tearDown(self):
+        codec.use()
+
+    def test_backends(self):
+        for name in codec.CODECS:
+            codec.use(name)
+            with self.subTest(name):
+                self.assertEqual(codec.loads(codec.dumpb(FC)), FC)
+            with self.subTest(name):
+                self.assertEqual(codec.loads(codec.dumps(FC)), FC)
+
+    def test_prefers_fast_backend(self):
+        self.assertEqual(codec.use().name, next(n for n in codec.PREFERENCE if n in codec.CODECS))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            codec.use("simdjson")
+
+    def test_feature_splitter(self):
+        features = [
+            {"type": "Feature", "id": i, "geometry": {"type": "Point", "coordinates": [i, i]},
+             "properties": {"name": 'br{ace} "quote" \\', "nested": {"features": [1]}}}
+            for i in range(20)
+        ]
+        data = json.dumps({"type": "FeatureCollection", "crs": {"type": "name"}, "features": features,
+                           "bbox": {"a": {}}}).encode()
+        spans = list(FeatureSplitter.spans(data))
+        with self.subTest():
+            self.assertEqual([json.loads(data[s:e]) for s, e in spans], features)
+        with self.subTest():
+            self.assertEqual([f for s, e, _ in shard_spans(spans, 3) for f in loads_features(data[s:e])], features)
+        for size in (1, 5, 64):
+            chunks = (data[i:i + size] for i in range(0, len(data), size))
+            with self.subTest(size):
+                self.assertEqual([json.loads(f) for f in FeatureSplitter().feed(chunks)], features)
+
+    def test_feature_splitter_truncated(self):
+        with self.assertRaises(ValueError):
+            list(FeatureSplitter().feed([b'{"type": "FeatureCollection", "features": [{"type": "Feat']))
+
+    def test_feature_manifest(self):
+        with self.subTest():
+            self.assertEqual(
+                feature_manifest(b'{"geometry": {"type": "Point", "coordinates": [1, 2]}, "id": "a1",'
+                                 b' "properties": {"files": [{"name": "x.jpg", "size": 3}]}}'),
+                ("a1", [{"name": "x.jpg", "size": 3}])
+            )
+        with self.subTest():
+            self.assertEqual(feature_manifest(b'{"properties": {"files": null}}'), (None, []))
+
+    def test_project_reader(self):
+        features = [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [i, i]},
+             "properties": {"files": [{"name": f"{i}.jpg"}]} if i % 2 else {"n": i}}
+            for i in range(10)
+        ]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "p.geojson")
+            with open(path, "w") as f:
+                json.dump({"type": "FeatureCollection", "features": features}, f)
+            with ProjectReader(path) as reader:
+                with self.subTest():
+                    self.assertEqual(len(reader), 10)
+                with self.subTest():
+                    self.assertEqual(reader.feature(3), features[3])
+                with self.subTest():
+                    self.assertEqual([reader.files(i) for i in (0, 1)], [[], [{"name": "1.jpg"}]])
+            with ProjectReader(path) as reader:
+                with self.subTest():
+                    self.assertEqual(list(reader), features)
+            with self.subTest():
+                self.assertTrue(os.path.exists(reader.index_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
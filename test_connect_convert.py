@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Unit Tests
+
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os.path
+import tempfile
+import unittest
+from xml.etree import ElementTree
+
+from gather_connect_mock import ProjectSpec, make_project
+from gather_connect_net import CancelledError
+
+try:
+    from osgeo import ogr
+    import gather_connect_convert as convert
+except ImportError:
+    ogr = None
+
+BOWTIE = {"type": "Polygon", "coordinates": [[[0, 0], [1, 1], [1, 0], [0, 1], [0, 0]]]}
+
+
+def point(i, properties):
+    return {"type": "Feature", "id": i, "geometry": {"type": "Point", "coordinates": [i, i]}, "properties": properties}
+
+
+class CancelAfter:
+    """ Token cancelled once it has been checked a number of times """
+
+    def __init__(self, checks):
+        self.checks = checks
+
+    def check(self):
+        self.checks -= 1
+        if self.checks < 0:
+            raise CancelledError()
+
+
+def read_layer(path, name=None):
+    ds = ogr.Open(path)
+    layer = ds.GetLayerByName(name) if name else ds.GetLayer(0)
+    features = [f for f in layer]
+    return ds, features
+
+
+@unittest.skipUnless(ogr, "needs GDAL")
+class Testing(unittest.TestCase):
+    def test_to_ogr(self):
+        geom, repaired = convert.to_ogr(point(0, {}))
+        with self.subTest():
+            self.assertEqual((geom.GetGeometryType(), repaired), (ogr.wkbMultiPoint, False))
+        geom, repaired = convert.to_ogr({"geometry": BOWTIE})
+        with self.subTest():
+            self.assertEqual((geom.GetGeometryType(), repaired), (ogr.wkbMultiPolygon, True))
+        with self.subTest():
+            self.assertTrue(geom.IsValid())
+        with self.subTest():
+            self.assertEqual(convert.to_ogr({"geometry": None}), (None, False))
+
+    def test_in_family(self):
+        collection = ogr.CreateGeometryFromWkt(
+            "GEOMETRYCOLLECTION (POLYGON ((0 0, 1 0, 1 1, 0 0)), LINESTRING (0 0, 2 2), POLYGON ((5 5, 6 5, 6 6, 5 5)))"
+        )
+        polygons = convert.in_family(collection, "polygons")
+        with self.subTest():
+            self.assertEqual((polygons.GetGeometryType(), polygons.GetGeometryCount()), (ogr.wkbMultiPolygon, 2))
+        with self.subTest():
+            self.assertEqual(convert.in_family(collection, "lines").GetGeometryCount(), 1)
+        with self.subTest():
+            self.assertIsNone(convert.in_family(collection, "points"))
+
+    def test_set_fields(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ds = ogr.GetDriverByName("GPKG").CreateDataSource(os.path.join(folder, "t.gpkg"))
+            layer = ds.CreateLayer("t", None, ogr.wkbPoint)
+            schema = {"n": "int", "s": "str", "tags": "json", "ok": "bool"}
+            layer.CreateField(ogr.FieldDefn(convert.ID_FIELD, ogr.OFTString))
+            for name, kind in schema.items():
+                layer.CreateField(convert.field_defn(name, kind))
+            out = ogr.Feature(layer.GetLayerDefn())
+            extra = convert.set_fields(out, {"id": 7, "properties": {
+                "n": "x", "s": 5, "tags": ["a"], "ok": True, "new": 1, "none": None
+            }}, schema)
+            with self.subTest():
+                self.assertEqual(extra, {"n": "x", "new": 1})
+            with self.subTest():
+                self.assertEqual(
+                    (out.GetField(convert.ID_FIELD), out.GetField("s"), json.loads(out.GetField("tags")), out.GetField("ok")),
+                    ("7", "5", ["a"], 1)
+                )
+            with self.subTest():
+                self.assertFalse(out.IsFieldSet("n"))
+            ds = None
+
+    def test_stream_writer(self):
+        features = [point(i, {"n": i}) for i in range(5)] + [point(5, {"n": "five", "late": True})]
+        for fmt in convert.STREAM_FORMATS:
+            if not convert.driver_available(fmt):
+                continue
+            with tempfile.TemporaryDirectory() as folder:
+                dest = os.path.join(folder, "p" + convert.STREAM_FORMATS[fmt][1])
+                with convert.StreamWriter(dest, fmt, sample=3) as writer:
+                    for feature in features:
+                        writer.add(feature)
+                with self.subTest(fmt):
+                    self.assertEqual(writer.stats, {"features": 6, "repaired": 0, "skipped": 0})
+                ds, out = read_layer(dest)
+                with self.subTest(fmt):
+                    self.assertEqual(sorted(f.GetField(convert.ID_FIELD) for f in out), [str(i) for i in range(6)])
+                with self.subTest(fmt):
+                    self.assertEqual(
+                        json.loads(next(f for f in out if f.GetField(convert.ID_FIELD) == "5").GetField(convert.EXTRA_FIELD)),
+                        {"n": "five", "late": True}
+                    )
+                ds = None
+
+    def test_stream_writer_few_features(self):
+        with tempfile.TemporaryDirectory() as folder:
+            dest = os.path.join(folder, "p.fgb")
+            with convert.StreamWriter(dest, "fgb") as writer:
+                writer.add(point(0, {"n": 0}))
+            ds, out = read_layer(dest)
+            self.assertEqual(len(out), 1)
+            ds = None
+
+    def test_stream_writer_failure(self):
+        # a failed write leaves the previous file as it was
+        with tempfile.TemporaryDirectory() as folder:
+            dest = os.path.join(folder, "p.fgb")
+            with convert.StreamWriter(dest, "fgb") as writer:
+                writer.add(point(0, {"n": 0}))
+            with self.assertRaises(RuntimeError):
+                with convert.StreamWriter(dest, "fgb", sample=1) as writer:
+                    writer.add(point(1, {"n": 1}))
+                    raise RuntimeError("connection lost")
+            with self.subTest():
+                self.assertEqual(os.listdir(folder), ["p.fgb"])
+            ds, out = read_layer(dest)
+            with self.subTest():
+                self.assertEqual([f.GetField(convert.ID_FIELD) for f in out], ["0"])
+            ds = None
+
+    def test_write_vrt(self):
+        with tempfile.TemporaryDirectory() as folder:
+            vrt = os.path.join(folder, "a&b <c>.vrt")
+            shard = os.path.join(folder, "a&b <c>_layers", "shard_000.gpkg")
+            convert.write_vrt(vrt, [shard])
+            sources = {e.text for e in ElementTree.parse(vrt).iter("SrcDataSource")}
+            self.assertEqual(sources, {os.path.join("a&b <c>_layers", "shard_000.gpkg")})
+
+    def test_convert(self):
+        spec = ProjectSpec("convert", features=60, files_per_feature=1)
+        project = make_project(spec)
+        project["features"][0]["geometry"] = BOWTIE
+        with tempfile.TemporaryDirectory() as folder, ThreadPoolExecutor(2) as pool:
+            path = os.path.join(folder, "convert.geojson")
+            with open(path, "w") as f:
+                json.dump(project, f)
+            # layers of a previous conversion are left alone until install_shards
+            os.makedirs(os.path.join(folder, "convert_layers"))
+            with open(os.path.join(folder, "convert_layers", "shard_000.gpkg"), "w") as f:
+                f.write("in use")
+            vrt, stats = convert.convert(path, pool, shards=3)
+            with self.subTest():
+                self.assertEqual((stats["features"], stats["skipped"]), (60, 0))
+            with self.subTest():
+                self.assertGreaterEqual(stats["repaired"], 1)
+            with self.subTest():
+                self.assertEqual(os.listdir(os.path.join(folder, "convert_layers")), ["shard_000.gpkg"])
+            with self.subTest():
+                self.assertFalse(os.path.exists(vrt))
+            convert.install_shards(vrt)
+            with self.subTest():
+                self.assertEqual(len(os.listdir(os.path.join(folder, "convert_layers"))), 3)
+            with self.subTest():
+                self.assertFalse(os.path.exists(os.path.join(folder, "convert_layers.new")))
+            counts = []
+            for name in convert.LAYER_NAMES:
+                ds, out = read_layer(vrt, name)
+                counts.append(len(out))
+                ds = None
+            with self.subTest():
+                self.assertEqual(sum(counts), 60)
+
+
+    def test_convert_cancelled(self):
+        project = make_project(ProjectSpec("cancelled", features=20, files_per_feature=0))
+        with tempfile.TemporaryDirectory() as folder, ThreadPoolExecutor(2) as pool:
+            path = os.path.join(folder, "cancelled.geojson")
+            with open(path, "w") as f:
+                json.dump(project, f)
+            with self.assertRaises(CancelledError):
+                convert.convert(path, pool, shards=2, cancel=CancelAfter(1))
+            self.assertEqual(os.listdir(folder), ["cancelled.geojson"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Unit Tests
+
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import io
+import os.path
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from gather_connect_files import BlobStore, Image, ThumbnailCache, is_image, make_thumbnail, python_executable
+
+
+class Testing(unittest.TestCase):
+    def test_is_image(self):
+        self.assertTrue(is_image("a.JPG"))
+        self.assertFalse(is_image("a.pdf"))
+
+    def test_thumbnail_cache(self):
+        data = b"not an image"
+        if Image is not None:
+            buf = io.BytesIO()
+            Image.new("RGB", (1024, 512)).save(buf, format="PNG")
+            data = buf.getvalue()
+        with tempfile.TemporaryDirectory() as folder:
+            with ThumbnailCache(folder, size=64, max_bytes=10**6) as cache:
+                cache.add("a.png", data)
+            with self.subTest():
+                self.assertTrue("a.png" in cache)
+            if Image is not None:
+                with Image.open(cache.path("a.png")) as img:
+                    self.assertEqual(img.size, (64, 32))
+
+    def test_thumbnail_unreadable(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for name, data in [("broken.jpg", b"\xff\xd8 not a jpeg"), ("empty.png", b"")]:
+                dest = os.path.join(folder, name)
+                make_thumbnail(data, dest)
+                with self.subTest(name), open(dest, "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_python_executable(self):
+        with tempfile.TemporaryDirectory() as prefix:
+            os.makedirs(os.path.join(prefix, "bin"))
+            python = os.path.join(prefix, "bin", "python3")
+            open(python, "w").close()
+            with mock.patch("sys.platform", "darwin"), mock.patch("sys.exec_prefix", prefix):
+                with mock.patch("sys.executable", "/Applications/QGIS.app/Contents/MacOS/QGIS"):
+                    with self.subTest():
+                        self.assertEqual(python_executable(), python)
+                with mock.patch("sys.executable", "/usr/bin/python3"):
+                    with self.subTest():
+                        self.assertIsNone(python_executable())
+
+    def test_thumbnail_eviction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ThumbnailCache(folder, max_bytes=250)
+            for i, name in enumerate(["old.jpg", "new.jpg", "used.jpg"]):
+                with open(cache.path(name), "wb") as f:
+                    f.write(b"x" * 100)
+                os.utime(cache.path(name), (time.time() - 100 + i, time.time() - 100 + i))
+            cache.touch("old.jpg")
+            removed = cache.evict()
+            with self.subTest():
+                self.assertEqual(removed, 1)
+            with self.subTest():
+                self.assertEqual(sorted(os.listdir(cache.folder)), ["old.jpg", "used.jpg"])
+
+    def test_blob_store(self):
+        with tempfile.TemporaryDirectory() as folder:
+            os.makedirs(os.path.join(folder, "a"))
+            os.makedirs(os.path.join(folder, "b"))
+            with BlobStore(folder) as store:
+                first = store.put("one.jpg", b"photo")
+                second = store.put("two.jpg", b"photo")
+                store.link("one.jpg", os.path.join(folder, "a", "one.jpg"))
+                store.link("two.jpg", os.path.join(folder, "b", "two.jpg"))
+            with self.subTest():
+                self.assertEqual(first, second)
+            with self.subTest():
+                self.assertEqual(len(os.listdir(os.path.join(store.blobs, first[:2]))), 1)
+
+            store = BlobStore(folder)
+            with self.subTest():
+                self.assertTrue("two.jpg" in store)
+            with self.subTest():
+                self.assertEqual(store.collect_garbage(), (0, 0))
+
+            os.remove(os.path.join(folder, "a", "one.jpg"))
+            os.remove(os.path.join(folder, "b", "two.jpg"))
+            with self.subTest():
+                self.assertEqual(BlobStore(folder).collect_garbage(), (1, 5))
+            with self.subTest():
+                self.assertFalse("one.jpg" in BlobStore(folder))
+
+            with BlobStore(folder) as store:
+                store.put("three.jpg", b"kept for later")
+            with self.subTest():
+                self.assertEqual(BlobStore(folder).read("three.jpg"), b"kept for later")
+
+    def test_blob_reference(self):
+        # an original previewed as a thumbnail is kept until its thumbnail is evicted
+        with tempfile.TemporaryDirectory() as folder:
+            thumbnail = os.path.join(folder, "a", ".thumbnails", "one.jpg")
+            os.makedirs(os.path.dirname(thumbnail))
+            with open(thumbnail, "wb") as f:
+                f.write(b"thumb")
+            with BlobStore(folder) as store:
+                store.put("one.jpg", b"photo")
+                store.reference("one.jpg", thumbnail)
+            with self.subTest():
+                self.assertEqual(BlobStore(folder).collect_garbage(), (0, 0))
+            os.remove(thumbnail)
+            with self.subTest():
+                self.assertEqual(BlobStore(folder).collect_garbage(), (1, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Unit Tests
+
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import unittest
+
+import gather_connect_forms as forms
+from gather_connect_forms import infer_form
+
+FIELDS = [("count", "int"), ("score", "double"), ("surveyor", "QString"), ("created", "QString"),
+          ("notes", "QString"), ("files", "QVariantList"), ("checked", "bool")]
+ROWS = [
+    (i, i / 4, ["ann", "bob"][i % 2], f"2023-01-{i + 1:02d}T12:00:00Z", f"note {i}" if i else None,
+     [{"name": f"{i}.jpg", "size": 3}], i % 2 == 0)
+    for i in range(10)
+]
+
+
+class Testing(unittest.TestCase):
+    def test_infer_form(self):
+        form = infer_form("layer", FIELDS, ROWS, complete=True)
+        fields = {f["name"]: f for f in form["fields"]}
+        with self.subTest():
+            self.assertEqual(fields["count"], {"name": "count", "type": "integer", "required": True, "min": 0, "max": 9})
+        with self.subTest():
+            self.assertEqual((fields["score"]["type"], fields["score"]["max"]), ("decimal", 2.25))
+        with self.subTest():
+            self.assertEqual(fields["surveyor"]["choices"], ["ann", "bob"])
+        with self.subTest():
+            self.assertEqual(fields["created"]["type"], "text")
+        with self.subTest():
+            self.assertEqual((fields["notes"]["type"], fields["notes"]["required"]), ("text", False))
+        with self.subTest():
+            self.assertEqual(fields["files"]["type"], "files")
+        with self.subTest():
+            self.assertEqual(fields["checked"]["type"], "boolean")
+
+    def test_sampled(self):
+        # a sample doesn't show every value a field can take, so it isn't closed to choices, a range or required
+        fields = infer_form("layer", FIELDS, ROWS)["fields"]
+        with self.subTest():
+            self.assertEqual(fields[0], {"name": "count", "type": "integer"})
+        with self.subTest():
+            self.assertEqual(fields[2], {"name": "surveyor", "type": "text"})
+
+    def test_declared_text(self):
+        form = infer_form("layer", [("code", "QString"), ("n", "")], [("01234", "01234"), ("00042", "00042")],
+                          complete=True)
+        self.assertEqual([f["type"] for f in form["fields"]], ["text", "integer"])
+
+    def test_large_integers(self):
+        big = 2 ** 60 + 1
+        field = infer_form("layer", [("n", "qlonglong")], [(big,), (big + 2,)], complete=True)["fields"][0]
+        self.assertEqual((field["min"], field["max"]), (big, big + 2))
+
+    def test_undeclared_types(self):
+        form = infer_form("layer", [("n", ""), ("x", None), ("b", "unknown")], [(1, 1.5, True), (2, 2, False)],
+                          complete=True)
+        with self.subTest():
+            self.assertEqual([f["type"] for f in form["fields"]], ["integer", "decimal", "boolean"])
+        with self.subTest():
+            self.assertEqual((form["fields"][1]["min"], form["fields"][1]["max"]), (1.5, 2))
+
+    def test_without_numpy(self):
+        np, forms.np = forms.np, None
+        try:
+            form = infer_form("layer", [("n", "")], [("1.5",), ("-2",), (None,)], complete=True)
+        finally:
+            forms.np = np
+        self.assertEqual(form["fields"][0], {"name": "n", "type": "decimal", "required": False, "min": -2, "max": 1.5})
+
+    def test_empty_layer(self):
+        form = infer_form("layer", [("a", "int")], [], complete=True)
+        self.assertEqual(form["fields"], [{"name": "a", "type": "integer", "required": False}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ Unit Tests
+
+ GatherConnector             : Fieldwork GIS Solution (QGIS Plugin)
+ Manage Gather projects      : http://LowlandGeospatial.com/Gather
+
+        date                 : 2023-01-23
+        copyright            : (C) 2023 by Lowland Geospatial
+        email                : info@lowlandgeospatial.solutions
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os.path
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import gather_connect_net
+from gather_connect_net import (
+    CancelledError, CancelToken, CircuitBreaker, CircuitOpenError, Fetch, FetchError, JobMetrics, Progress, RateLimiter,
+    RetryPolicy
+)
+
+FAST = RetryPolicy(connect_timeout=1, read_timeout=0.5, retries=3, backoff=0.01, max_backoff=0.05)
+
+
+class FaultServer(ThreadingHTTPServer):
+    """
+    Local stub answering each request with the next scripted fault:
+    an int status, "reset" (drop the connection), "hang" (never answer) or "ok"
+    """
+    daemon_threads = True
+
+    def __init__(self, script):
+        super().__init__(("127.0.0.1", 0), FaultHandler)
+        self.script = list(script)
+        self.requests = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server_address[1]}"
+
+
+class FaultHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.do_GET()
+
+    def do_GET(self):
+        self.server.requests += 1
+        fault = self.server.script.pop(0) if self.server.script else "ok"
+        if fault == "reset":
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, b"\x01\x00\x00\x00\x00\x00\x00\x00")
+            self.connection.close()
+            return
+        if fault == "hang":
+            time.sleep(2)
+            return
+        status = 200 if fault == "ok" else fault
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        body = b'{"ok": true}'
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Testing(unittest.TestCase):
+    def setUp(self):
+        gather_connect_net._breakers.clear()
+        gather_connect_net._limiters.clear()
+
+    def fetch(self, server, policy=FAST):
+        return Fetch.fetch(host=server.host, url="/", headers={}, policy=policy, secure=False)
+
+    def test_retry_statuses(self):
+        server = FaultServer([503, 429, 502])
+        with self.subTest():
+            self.assertEqual(self.fetch(server), b'{"ok": true}')
+        with self.subTest():
+            self.assertEqual(server.requests, 4)
+        server.shutdown()
+
+    def test_no_retry_client_error(self):
+        server = FaultServer([404])
+        with self.assertRaises(FetchError) as ctx:
+            self.fetch(server)
+        with self.subTest():
+            self.assertEqual(ctx.exception.status, 404)
+        with self.subTest():
+            self.assertEqual(server.requests, 1)
+        server.shutdown()
+
+    def test_reset_and_timeout(self):
+        server = FaultServer(["reset", "hang"])
+        with self.subTest():
+            self.assertEqual(self.fetch(server), b'{"ok": true}')
+        with self.subTest():
+            self.assertEqual(server.requests, 3)
+        server.shutdown()
+
+    def test_post_timeout(self):
+        # the server may have acted on a POST that timed out, so it is not sent again
+        server = FaultServer(["hang"])
+        with self.assertRaises(OSError):
+            Fetch.fetch(host=server.host, url="/", headers={}, payload=b'{"a": 1}', verb="POST",
+                        policy=replace(FAST, idempotent=False), secure=False)
+        with self.subTest():
+            self.assertEqual(server.requests, 1)
+        server.shutdown()
+
+    def test_post_retry_status(self):
+        server = FaultServer([503])
+        with self.subTest():
+            self.assertEqual(Fetch.fetch(host=server.host, url="/", headers={}, payload=b'{"a": 1}', verb="POST",
+                                         policy=replace(FAST, idempotent=False), secure=False), b'{"ok": true}')
+        with self.subTest():
+            self.assertEqual(server.requests, 2)
+        server.shutdown()
+
+    def test_retries_spent(self):
+        server = FaultServer([500] * 10)
+        with self.assertRaises(FetchError):
+            self.fetch(server)
+        with self.subTest():
+            self.assertEqual(server.requests, FAST.retries + 1)
+        server.shutdown()
+
+    def test_circuit_breaker(self):
+        server = FaultServer([503] * 10)
+        gather_connect_net._breakers[server.host] = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        with self.assertRaises(CircuitOpenError):
+            self.fetch(server)
+        with self.assertRaises(CircuitOpenError):
+            self.fetch(server)
+        with self.subTest():
+            self.assertEqual(server.requests, 2)
+        server.shutdown()
+
+    def test_stream(self):
+        server = FaultServer([503])
+        metrics = JobMetrics("test")
+        res = Fetch.request(host=server.host, url="/", headers={}, policy=FAST, secure=False, metrics=metrics, operation="get")
+        with self.subTest():
+            self.assertEqual(b"".join(Fetch.chunks(res, 5)), b'{"ok": true}')
+        with self.subTest():
+            self.assertEqual(metrics.ops[0].bytes_received, 12)
+        server.shutdown()
+
+    def test_cancel(self):
+        server = FaultServer(["hang"] * 3)
+        cancel = CancelToken()
+        threading.Timer(0.2, cancel.cancel).start()
+        start = time.monotonic()
+        with self.assertRaises(CancelledError):
+            Fetch.fetch(host=server.host, url="/", headers={}, policy=RetryPolicy(read_timeout=5), secure=False,
+                        cancel=cancel)
+        with self.subTest():
+            self.assertLess(time.monotonic() - start, 1)
+        with self.subTest():
+            self.assertEqual(server.requests, 1)
+        server.shutdown()
+
+    def test_progress(self):
+        progress = Progress()
+        with self.subTest():
+            self.assertEqual(progress.update("files", 0, 10), (0, "files: 0 of 10"))
+        percent, text = progress.update("files", 5, 10)
+        with self.subTest():
+            self.assertEqual(percent, 50)
+        percent, text = progress.update("project", 2 ** 20, 4 * 2 ** 20)
+        with self.subTest():
+            self.assertEqual(percent, (50 + 25) / 2)
+        with self.subTest():
+            self.assertEqual(text, "files: 5 of 10; project: 1.0 of 4.0 MB")
+
+    def test_progress_rate(self):
+        progress = Progress()
+        progress.MIN_ELAPSED = 0.05
+        progress.update("project", 0, 4 * 2 ** 20)
+        progress.update("files", 0, 10)
+        time.sleep(0.1)
+        # interleaved updates don't restart the other stage's clock
+        progress.update("files", 1, 10)
+        _, text = progress.update("project", 2 ** 20, 4 * 2 ** 20)
+        project = text.split("; ")[0]
+        with self.subTest():
+            self.assertTrue(project.startswith("project: 1.0 of 4.0 MB, "))
+        rate = float(project.split(", ")[1].split(" ")[0])
+        with self.subTest():
+            self.assertLess(rate, 20)
+        _, text = progress.update("files", 10, 10)
+        with self.subTest():
+            self.assertTrue(text.startswith("project: 1.0 of 4.0 MB") and "files: 10 of 10" in text)
+        _, text = progress.update("project", 2 ** 21, 4 * 2 ** 20)
+        with self.subTest():
+            self.assertNotIn("files", text)
+
+    def test_retry_after(self):
+        policy = RetryPolicy(max_backoff=10)
+        with self.subTest():
+            self.assertEqual(policy.delay(0, "3"), 3)
+        with self.subTest():
+            self.assertEqual(policy.delay(0, "120"), 10)
+        with self.subTest():
+            self.assertLessEqual(policy.delay(3), policy.backoff * 8)
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(11):
+            limiter.acquire()
+            limiter.release(200)
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_rate_adapts(self):
+        limiter = RateLimiter(rate=8, max_rate=10, min_rate=1, increase=2)
+        limiter.acquire()
+        limiter.release(429)
+        with self.subTest():
+            self.assertEqual(limiter.rate, 4)
+        for _ in range(100):
+            limiter.tokens = limiter.burst
+            limiter.acquire()
+            limiter.release(200)
+        with self.subTest():
+            self.assertEqual(limiter.rate, 10)
+
+    def test_in_flight_cap(self):
+        limiter = RateLimiter(rate=1000, max_in_flight=2)
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def call():
+            limiter.acquire()
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.pop()
+            limiter.release(200)
+
+        threads = [threading.Thread(target=call) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(max(peak), 2)
+
+    def test_metrics(self):
+        server = FaultServer([503])
+        metrics = JobMetrics("test")
+        Fetch.fetch(host=server.host, url="/", headers={}, policy=FAST, secure=False, metrics=metrics, operation="get")
+        with metrics.timed("get", "decode", 12):
+            pass
+        totals = metrics.finish().totals()["get"]
+        with self.subTest():
+            self.assertEqual((totals["count"], totals["errors"]), (1, 0))
+        with self.subTest():
+            self.assertEqual(totals["bytes_received"], 12)
+        with self.subTest():
+            self.assertEqual(metrics.ops[0].attempts, 2)
+        with self.subTest():
+            self.assertGreater(totals["ttfb"], 0)
+        with self.subTest():
+            self.assertIn("get: 1 requests", metrics.summary())
+        with tempfile.TemporaryDirectory() as folder:
+            metrics.export(os.path.join(folder, "m.csv"))
+            metrics.export(os.path.join(folder, "m.json"))
+            with open(os.path.join(folder, "m.csv")) as f:
+                with self.subTest():
+                    self.assertEqual(len(f.readlines()), 3)
+            with open(os.path.join(folder, "m.json")) as f:
+                with self.subTest():
+                    self.assertEqual(json.load(f)["totals"]["get"]["count"], 1)
+            # saved jobs are capped, the oldest removed first
+            metrics_folder = os.path.join(folder, "metrics")
+            for started in range(3):
+                metrics.started = started * 86400
+                metrics.save(metrics_folder, keep=2)
+            with self.subTest():
+                self.assertEqual(len(os.listdir(metrics_folder)), 4)
+            with self.subTest():
+                self.assertFalse(any(name.startswith(time.strftime("%Y%m%d", time.localtime(0)))
+                                     for name in os.listdir(metrics_folder)))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()